@@ -252,7 +252,7 @@ COMMAND_DISPLAY_AGENTS = "agents"
 # ----- Limits -----
 MAX_AGENTS = 30           # agent pool capacity; the longest-idle soldier is dropped when full
 MAX_MISSION_BEATS = 1000  # maximum captain beats per mission
-MAX_DECISION_RETRIES = 5  # consecutive unusable decisions before force-completing
+MAX_DECISION_RETRIES = 2  # consecutive unusable decisions (failed model calls) before force-completing
 
 ROSTER_SUMMARY_LIMIT = 400
 
@@ -365,7 +365,7 @@ def _update_plan(mission: str, data: str, plan: str, situation: str) -> str:
               + HEADER_SITUATION + situation
               + PLAN_GUIDE)
 
-    response = core.send_prompt(PLAN_SYSTEM_PROMPT, prompt, captain.context[:], hide_reasoning = True)
+    response = core.send_prompt(PLAN_SYSTEM_PROMPT, prompt, captain.context[:], hide_reasoning = True, call_type = core.CALL_TYPE_AGENT)
 
     return response or plan
 
@@ -379,7 +379,14 @@ def _decide(mission: str, data: str, plan: str, situation: str) -> tuple[str, in
               + HEADER_SITUATION + situation
               + DECISION_GUIDE)
 
-    response = core.send_prompt(DECISION_SYSTEM_PROMPT, prompt, captain.context[:], hide_reasoning = True)
+    # The move is restricted to SPAWN, COMPLETE or TALK to a soldier in the team
+    choices = [MOVE_SPAWN, MOVE_COMPLETE] + [f"{MOVE_TALK} {agent_id}" for agent_id in agent_pool]
+
+    response = core.send_prompt(DECISION_SYSTEM_PROMPT, prompt, captain.context[:], hide_reasoning = True, call_type = core.CALL_TYPE_AGENT, choices = choices)
+
+    # An error text of core is a failed call, never a move (not even the words it contains)
+    if response.strip() == core.OVERSIZED_PROMPT_ERROR.strip():
+        return MOVE_INVALID, None
 
     return _parse_decision(response)
 
@@ -393,7 +400,7 @@ def _conceive_agent(mission: str, situation: str) -> tuple[str, str]:
               + HEADER_SITUATION + situation
               + CONCEIVE_GUIDE)
 
-    response = core.send_prompt(captain.primeDirectives, prompt, captain.context[:], hide_reasoning = True)
+    response = core.send_prompt(captain.primeDirectives, prompt, captain.context[:], hide_reasoning = True, call_type = core.CALL_TYPE_AGENT)
 
     return _parse_agent_brief(response)
 
@@ -404,8 +411,8 @@ def _captain_say(scene: str, instruction: str) -> str:
     # directive that shapes this line and is then stripped from stored context.
     _print_speaker(captain.name)
 
-    response = core.send_prompt(captain.primeDirectives, scene + instruction, captain.context)
-    comms.printMagiText("\n" + response)
+    response = core.send_prompt(captain.primeDirectives, scene + instruction, captain.context, stream = True)
+    comms.printMagiText("\n" + response, streamed = True)
 
     # Keep the durable scene in memory; remove the transient instruction.
     # Search for instruction.rstrip(), not instruction: send_prompt stores the
@@ -427,8 +434,8 @@ def _soldier_say(soldier: Agent, message: str) -> str:
     # Pure dialogue from a soldier — e.g., answering the captain's introduction.
     _print_speaker(soldier.name)
 
-    reply = core.send_prompt(soldier.primeDirectives, message, soldier.context)
-    comms.printMagiText("\n" + reply)
+    reply = core.send_prompt(soldier.primeDirectives, message, soldier.context, stream = True)
+    comms.printMagiText("\n" + reply, streamed = True)
 
     return core.remove_reasoning(reply)
 
@@ -504,6 +511,7 @@ def runMission(mission: str, data: str) -> str:
     retries = 0
 
     for _ in range(MAX_MISSION_BEATS):
+        core.check_cancelled()
         plan = _update_plan(mission, data, plan, situation)
         move, target = _decide(mission, data, plan, situation)
 
@@ -549,7 +557,7 @@ def runMission(mission: str, data: str) -> str:
 
             continue
 
-        # Unparseable decision, or TALK aimed at a soldier that does not exist
+        # The decision is constrained to valid moves, so an unusable one means the model call failed
         retries += 1
 
         if not agent_pool:
@@ -0,0 +1,410 @@
+import json
+import time
+import uuid
+import queue
+import select
+import socket
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections.abc import Callable
+from typing import Any
+import core
+import toolchain
+
+API_HOST = "127.0.0.1"  # Localhost only, the API has no authentication
+API_TEXT = "\nHTTP API listening on http://"
+API_MODEL = "magi"
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+COMPLETIONS_PATH = "/v1/completions"
+MODELS_PATH = "/v1/models"
+SESSION_HEADER = "X-Session-Id"
+QUEUE_TIME_HEADER = "X-Queue-Time-Ms"
+PROCESSING_TIME_HEADER = "X-Processing-Time-Ms"
+RETRY_AFTER_SECONDS = 1
+SSE_DONE = "[DONE]"
+FINISH_REASON_STOP = "stop"
+QUEUE_FULL_ERROR = "Too many requests are waiting for the model, try again later."
+NOT_FOUND_ERROR = "Unknown endpoint: "
+REQUEST_ERROR = "Invalid request: "
+MISSING_PROMPT_ERROR = "The request has no prompt."
+CANCELLED_ERROR = "The client disconnected, the request was cancelled."
+CANCELLED_STATUS = 499
+STOPPED_ERROR = "MAGI stopped after a fatal error."
+CONNECTION_CHECK_SECONDS = 1  # Waiting clients are checked for a closed connection at this interval
+
+
+class ApiError(Exception):
+    # Error returned to the client with its HTTP status
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+    # API request, run by the worker in arrival order
+    def __init__(self, run: Callable[[list[str]], str], session_id: str, history: list[str], stream: bool, connected: Callable[[], bool] | None = None) -> None:
+        self.run = run
+        self.session_id = session_id
+        self.history = history
+        self.stream = stream
+        self.connected = connected or (lambda: True)
+        self.created = time.time()
+
+        # Set when the client leaves, the job is then skipped or stopped
+        self.cancelled = threading.Event()
+
+        # Events for the request handler: start, text, done and error
+        self.events: queue.Queue[tuple[str, Any]] = queue.Queue()
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, primeDirectives: str, queue_size: int, session_limit: int) -> None:
+        self.primeDirectives = primeDirectives
+
+        # Requests beyond the queue size are rejected, so clients back off instead of piling up
+        self.jobs: queue.Queue[Job] = queue.Queue(queue_size)
+
+        # MAGI context of each session id, least recently used first, only used by the worker
+        self.sessions: OrderedDict[str, list[str]] = OrderedDict()
+        self.session_limit = session_limit
+
+        # Running job, cancelled through core when its client leaves
+        self.current: Job | None = None
+        self.lock = threading.Lock()
+
+        # Set when core exits during a job, the server stops with it
+        self.stopped = False
+
+        super().__init__((API_HOST, port), ApiHandler)
+
+        self.worker = threading.Thread(target = self._work, daemon = True)
+        self.worker.start()
+
+    def _work(self) -> None:
+        # One request at a time, core runs a single conversation in this process
+        while True:
+            job = self.jobs.get()
+
+            # The client left while the request was waiting
+            if job.cancelled.is_set() or not job.connected():
+                job.events.put(("error", (CANCELLED_ERROR, CANCELLED_STATUS)))
+                continue
+
+            with self.lock:
+                self.current = job
+                core.cancel_event.clear()
+
+            job.events.put(("start", _elapsed_ms(job.created)))
+            start = time.time()
+
+            # Streamed requests receive the response text while it is generated, and all requests the system text of their tools
+            core.stream_listener = (lambda text: job.events.put(("text", text))) if job.stream else None
+            core.system_listener = lambda text: job.events.put(("system", text)) if threading.current_thread() is self.worker else None
+
+            try:
+                context = self._get_session(job.session_id) if job.session_id else job.history
+                job.events.put(("done", (job.run(context), _elapsed_ms(start))))
+
+            except ApiError as e:
+                job.events.put(("error", (str(e), e.status)))
+
+            except core.JobCancelled:
+                job.events.put(("error", (CANCELLED_ERROR, CANCELLED_STATUS)))
+
+            except Exception as e:
+                job.events.put(("error", (str(e) or type(e).__name__, 500)))
+
+            except BaseException:
+                # core exits on fatal model errors, the server does not keep running on that model
+                job.events.put(("error", (STOPPED_ERROR, 500)))
+                self.stopped = True
+                self.shutdown()
+                raise
+
+            finally:
+                core.stream_listener = None
+                core.system_listener = None
+
+                with self.lock:
+                    self.current = None
+                    core.cancel_event.clear()
+
+    def _get_session(self, session_id: str) -> list[str]:
+        context = self.sessions.pop(session_id, [])
+        self.sessions[session_id] = context
+
+        while len(self.sessions) > self.session_limit:
+            self.sessions.popitem(last = False)
+
+        return context
+
+    def cancel(self, job: Job) -> None:
+        with self.lock:
+            job.cancelled.set()
+
+            if self.current is job:
+                core.cancel_event.set()
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server: ApiServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Requests are not printed to the MAGI console
+        pass
+
+    def do_GET(self) -> None:
+        if self.path == MODELS_PATH:
+            self._send_json(200, {"object": "list", "data": [{"id": API_MODEL, "object": "model", "owned_by": API_MODEL}]})
+        else:
+            self._send_error(404, NOT_FOUND_ERROR + self.path)
+
+    def do_POST(self) -> None:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            if not isinstance(body, dict):
+                raise ValueError(type(body).__name__)
+
+        except ValueError as e:
+            self._send_error(400, REQUEST_ERROR + str(e))
+            return
+
+        if self.path == CHAT_COMPLETIONS_PATH:
+            self._chat_completion(body)
+        elif self.path == COMPLETIONS_PATH:
+            self._completion(body)
+        else:
+            self._send_error(404, NOT_FOUND_ERROR + self.path)
+
+    def _chat_completion(self, body: dict[str, Any]) -> None:
+        messages = body.get("messages") or []
+        messages = [message for message in messages if isinstance(message, dict)]
+        system = [_message_text(message) for message in messages if message.get("role") == "system"]
+        turns = [message for message in messages if message.get("role") in ("user", "assistant")]
+
+        if not turns or turns[-1].get("role") != "user":
+            self._send_error(400, MISSING_PROMPT_ERROR)
+            return
+
+        primeDirectives = system[-1] if system else self.server.primeDirectives
+        prompt = _message_text(turns[-1])
+
+        # Without a session id, the earlier messages are the conversation history
+        history = [core.SYSTEM_TEXT + primeDirectives.strip() + core.EOS]
+
+        for message in turns[:-1]:
+            if message.get("role") == "user":
+                history.append(core.format_user_turn(_message_text(message)))
+            else:
+                history.append(_message_text(message).strip() + core.EOS)
+
+        # Normal mode action: tools, Codex and the Core Protocol
+        def run(context: list[str]) -> str:
+            _check_prompt(prompt)
+            response: str = toolchain.runAction(primeDirectives, prompt, context)
+
+            return response
+
+        self._run_job(run, history, body, "chat.completion")
+
+    def _completion(self, body: dict[str, Any]) -> None:
+        prompt = body.get("prompt")
+
+        if isinstance(prompt, list):
+            prompt = "".join(str(part) for part in prompt)
+
+        if not prompt or not isinstance(prompt, str):
+            self._send_error(400, MISSING_PROMPT_ERROR)
+            return
+
+        stream = bool(body.get("stream"))
+
+        # Plain completion, without tools or Codex
+        def run(context: list[str]) -> str:
+            _check_prompt(prompt)
+
+            return core.send_prompt(self.server.primeDirectives, prompt, context, hide_reasoning = True, stream = stream)
+
+        self._run_job(run, [], body, "text_completion")
+
+    def _run_job(self, run: Callable[[list[str]], str], history: list[str], body: dict[str, Any], kind: str) -> None:
+        session_id = self.headers.get(SESSION_HEADER) or ""
+        job = Job(run, session_id, history, bool(body.get("stream")), self._connected)
+
+        try:
+            self.server.jobs.put_nowait(job)
+
+        except queue.Full:
+            self._send_error(429, QUEUE_FULL_ERROR, {"Retry-After": str(RETRY_AFTER_SECONDS)})
+            return
+
+        completion_id = ("chatcmpl-" if kind == "chat.completion" else "cmpl-") + uuid.uuid4().hex
+        created = int(time.time())
+        event, data = self._next_event(job)
+
+        if event == "error":
+            self._send_error(data[1], data[0])
+            return
+
+        queue_ms = data
+        timing_headers = {QUEUE_TIME_HEADER: str(queue_ms)}
+
+        if session_id:
+            timing_headers[SESSION_HEADER] = session_id
+
+        if job.stream:
+            self._stream_job(job, completion_id, created, kind, timing_headers)
+            return
+
+        # The system text of the tools comes before the response, like in the console
+        system_text = ""
+        event, data = self._next_event(job)
+
+        while event in ("text", "system"):
+            system_text += data if event == "system" else ""
+            event, data = self._next_event(job)
+
+        if event == "error":
+            self._send_error(data[1], data[0], timing_headers)
+            return
+
+        response, processing_ms = data
+        response = (system_text.strip() + "\n\n" + response) if system_text.strip() else response
+        timing_headers[PROCESSING_TIME_HEADER] = str(processing_ms)
+        timing_headers["Server-Timing"] = f"queue;dur={queue_ms}, processing;dur={processing_ms}"
+        self._send_json(200, _completion_object(completion_id, created, kind, response, FINISH_REASON_STOP, False), timing_headers)
+
+    def _stream_job(self, job: Job, completion_id: str, created: int, kind: str, headers: dict[str, str]) -> None:
+        # Server-sent events, one chunk per piece of rendered text
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            while True:
+                event, data = self._next_event(job)
+
+                if event in ("text", "system"):
+                    self._send_event(_completion_object(completion_id, created, kind, data, None, True))
+
+                elif event == "done":
+                    chunk = _completion_object(completion_id, created, kind, "", FINISH_REASON_STOP, True)
+                    chunk["timings"] = {"queue_ms": int(headers[QUEUE_TIME_HEADER]), "processing_ms": data[1]}
+                    self._send_event(chunk)
+                    break
+
+                else:
+                    self._send_event({"error": {"message": data[0], "code": data[1]}})
+                    break
+
+            self._send_event(SSE_DONE)
+
+        except (BrokenPipeError, ConnectionResetError):
+            # The client left, stop its job to free the model
+            self.server.cancel(job)
+
+    def _next_event(self, job: Job) -> tuple[str, Any]:
+        # A client that leaves while it waits cancels its job, queued or running
+        while True:
+            try:
+                return job.events.get(timeout = CONNECTION_CHECK_SECONDS)
+
+            except queue.Empty:
+                if not job.cancelled.is_set() and not self._connected():
+                    self.server.cancel(job)
+
+    def _connected(self) -> bool:
+        # A closed connection is readable with no data left
+        try:
+            ready, _, _ = select.select([self.connection], [], [], 0)
+
+            return not ready or bool(self.connection.recv(1, socket.MSG_PEEK))
+
+        except OSError:
+            return False
+
+    def _send_event(self, data: Any) -> None:
+        text = data if isinstance(data, str) else json.dumps(data)
+        self.wfile.write(f"data: {text}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+    def _send_json(self, status: int, data: dict[str, Any], headers: dict[str, str] | None = None) -> None:
+        content = json.dumps(data).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_error(self, status: int, message: str, headers: dict[str, str] | None = None) -> None:
+        try:
+            self._send_json(status, {"error": {"message": message, "code": status}}, headers)
+
+        except (BrokenPipeError, ConnectionResetError):
+            # The client left before the error
+            pass
+
+
+def _elapsed_ms(start: float) -> int:
+    return int((time.time() - start) * 1000)
+
+
+def _message_text(message: dict[str, Any]) -> str:
+    content = message.get("content") or ""
+
+    # Content parts of multimodal messages, only the text is used
+    if isinstance(content, list):
+        content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+
+    return str(content)
+
+
+def _check_prompt(prompt: str) -> None:
+    prompt_tokens = core.count_text_tokens(prompt)
+
+    if prompt_tokens > core.MAX_INPUT_TOKENS:
+        raise ApiError(core.MAX_INPUT_TOKENS_WARNING.strip() + str(prompt_tokens))
+
+
+def _completion_object(completion_id: str, created: int, kind: str, text: str, finish_reason: str | None, chunk: bool) -> dict[str, Any]:
+    # OpenAI response objects, chat completions use messages and deltas
+    if kind == "chat.completion":
+        choice: dict[str, Any] = {"index": 0, "delta": {"content": text}} if chunk else {"index": 0, "message": {"role": "assistant", "content": text}}
+        object_name = "chat.completion.chunk" if chunk else kind
+    else:
+        choice = {"index": 0, "text": text}
+        object_name = kind
+
+    choice["finish_reason"] = finish_reason
+
+    return {"id": completion_id, "object": object_name, "created": created, "model": API_MODEL, "choices": [choice]}
+
+
+def main(primeDirectives: str) -> int:
+    with ApiServer(core.API_PORT, primeDirectives, core.API_QUEUE_SIZE, core.API_SESSIONS) as server:
+        core.print_system_text(API_TEXT + f"{API_HOST}:{core.API_PORT}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    return 1 if server.stopped else 0
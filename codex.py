@@ -1,6 +1,7 @@
 import core
 import comms
 import json
+from typing import Any
 from plugins.codex import codex_operations
 from plugins.codex.codex_operations import CODEX_LIST_ALL
 from plugins.codex.codex_operations import CODEX_NO_RESULT
@@ -81,6 +82,16 @@ CODEX_RETRY_WRITE_PROMPT = """\n\nIMPORTANT: The previous attempt failed to prod
 Re-read the STRICT RULES and OUTPUT CONTRACT carefully.
 Pay special attention to factual accuracy and do not alter details from the original ACTION.
 Output EXACTLY one valid JSON object and NOTHING ELSE."""
+CODEX_WRITE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string", "minLength": 1},
+        "content": {"type": "string", "minLength": 1},
+        "tags": {"type": "string"}
+    },
+    "required": ["title", "content", "tags"],
+    "additionalProperties": False
+}
 CODEX_MERGE_DECISION_PROMPT_1 = """You are updating a long-term memory entry that already exists.
 
 Below are the EXISTING lines already stored for this entry, each prefixed with its index in square brackets, followed by the NEW information being added under the same title. Each line is one independent unit (for user facts, one fact per line); judge each line on its own.
@@ -186,6 +197,17 @@ def _parse_json_response(response: str) -> dict:
     return {"title": title, "content": content, "tags": tags}
 
 
+def _drop_schema(indices: list[int]) -> dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": {
+            "drop": {"type": "array", "items": {"enum": indices}}
+        },
+        "required": ["drop"],
+        "additionalProperties": False
+    }
+
+
 def _parse_drop_decision(response: str, num_lines: int) -> set:
     """Return the set of valid 1-based line indices the model asked to drop.
 
@@ -352,8 +374,12 @@ def _merge_content(new_content: str, old_content: str) -> str:
         + CODEX_MERGE_DECISION_PROMPT_2B
     )
 
-    response = core.send_prompt(CODEX_SYSTEM_PROMPT, prompt, [], hide_reasoning = True)
+    # The drop list can only hold indices of the numbered lines
+    indices = [index for index, line in enumerate(lines, 1) if line.strip()]
+
+    response = core.send_prompt(CODEX_SYSTEM_PROMPT, prompt, [], hide_reasoning = True, call_type = core.CALL_TYPE_CODEX, json_schema = _drop_schema(indices))
 
+    # An error text or unparsable response drops nothing, so the old content is kept whole
     drop = _parse_drop_decision(response, len(lines))
 
     # Survivors copied verbatim from the canonical original.
@@ -367,7 +393,7 @@ def _merge_content(new_content: str, old_content: str) -> str:
 
 def read_codex(action: str) -> str:
     # Extract search query from the action
-    response = core.send_prompt(CODEX_SYSTEM_PROMPT, CODEX_EXTRACT_QUERY_PROMPT + action, [], hide_reasoning = True)
+    response = core.send_prompt(CODEX_SYSTEM_PROMPT, CODEX_EXTRACT_QUERY_PROMPT + action, [], hide_reasoning = True, call_type = core.CALL_TYPE_CODEX, one_line = True)
 
     # Get the last line
     lines = response.split('\n')
@@ -395,8 +421,8 @@ def read_codex(action: str) -> str:
 def write_codex(action: str) -> str:
     aux_context: list[str] = []
 
-    # Extract title, content and tags from the action
-    response = core.send_prompt(CODEX_SYSTEM_PROMPT, CODEX_EXTRACT_WRITE_PROMPT_1 + action + CODEX_EXTRACT_WRITE_PROMPT_2, aux_context, hide_reasoning = True)
+    # Extract title, content and tags from the action (the schema keeps the JSON object well-formed)
+    response = core.send_prompt(CODEX_SYSTEM_PROMPT, CODEX_EXTRACT_WRITE_PROMPT_1 + action + CODEX_EXTRACT_WRITE_PROMPT_2, aux_context, hide_reasoning = True, call_type = core.CALL_TYPE_CODEX, json_schema = CODEX_WRITE_SCHEMA)
 
     fields = _parse_json_response(response)
     title = fields["title"]
@@ -404,9 +430,9 @@ def write_codex(action: str) -> str:
     tags = fields["tags"]
 
     if not title or not content:
-        # Fix json structure
+        # The call returned an error text instead of the JSON object
         retry_prompt = CODEX_EXTRACT_WRITE_PROMPT_1 + action + CODEX_EXTRACT_WRITE_PROMPT_2 + CODEX_RETRY_WRITE_PROMPT
-        response = core.send_prompt(CODEX_SYSTEM_PROMPT, retry_prompt, aux_context, hide_reasoning = True)
+        response = core.send_prompt(CODEX_SYSTEM_PROMPT, retry_prompt, aux_context, hide_reasoning = True, call_type = core.CALL_TYPE_CODEX, json_schema = CODEX_WRITE_SCHEMA)
 
         fields = _parse_json_response(response)
         title = fields["title"]
@@ -460,7 +486,7 @@ def write_codex(action: str) -> str:
 
 def delete_codex(action: str) -> str:
     # Extract entry title from the action
-    response = core.send_prompt(CODEX_SYSTEM_PROMPT, CODEX_EXTRACT_TITLE_PROMPT + action, [], hide_reasoning = True)
+    response = core.send_prompt(CODEX_SYSTEM_PROMPT, CODEX_EXTRACT_TITLE_PROMPT + action, [], hide_reasoning = True, call_type = core.CALL_TYPE_CODEX)
 
     # Get the last line
     lines = response.split('\n')
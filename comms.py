@@ -1,7 +1,9 @@
 from plugins.telegram_bot import telegram_bot
 from PIL import Image
 import time
+import queue
 import asyncio
+import threading
 import core
 
 # COMMS
@@ -24,12 +26,22 @@ telegram_bot_enabled: bool = False
 
 telegram_message_queue: list[str] = []
 
+# User input is read in the background, so messages received during a job cancel it
+input_queue: queue.Queue[str] = queue.Queue()
+input_thread: threading.Thread | None = None
+job_running = threading.Event()
 
-def printMagiText(text: str) -> None:
+# Disabled in daemon mode, where the input comes from the attached clients and Telegram
+console_input: bool = True
+
+
+def printMagiText(text: str, streamed: bool = False) -> None:
     if telegram_bot_enabled:
         _send_telegram_bot(text)
 
-    core.print_magi_text(text)
+    # Streamed responses are already printed to the console
+    if not streamed:
+        core.print_magi_text(text)
 
 
 def printSystemText(text: str) -> None:
@@ -39,7 +51,53 @@ def printSystemText(text: str) -> None:
     core.print_system_text(text)
 
 
-def userInput() -> str:
+def userInput(timeout: float | None = None) -> str:
+    global input_thread
+
+    if (console_input or telegram_bot_enabled) and input_thread is None:
+        input_thread = threading.Thread(target = _read_input_loop, daemon = True)
+        input_thread.start()
+
+    # Sleeps until a message arrives or the timeout (the next heartbeat) expires, None waits for a message
+    try:
+        return input_queue.get(timeout = timeout)
+
+    except queue.Empty:
+        return ""
+
+
+def start_job() -> None:
+    core.cancel_event.clear()
+    job_running.set()
+
+
+def end_job() -> None:
+    job_running.clear()
+    core.cancel_event.clear()
+
+
+def receive_input(message: str) -> None:
+    input_queue.put(message)
+
+    # A new message or the exit command stops the running job, and is read next
+    if job_running.is_set():
+        core.cancel_event.set()
+
+
+def _read_input_loop() -> None:
+    while True:
+        try:
+            message = _read_input()
+
+        except EOFError:
+            # Nothing more to read from a closed stdin
+            return
+
+        if message:
+            receive_input(message)
+
+
+def _read_input() -> str:
     if telegram_bot_enabled:
         message = _receive_telegram_bot()
 
@@ -47,7 +105,8 @@ def userInput() -> str:
             core.print_system_text(TELEGRAM_TAG + message)
             _send_telegram_bot(MESSAGE_RECEIVED_TEXT_1 + message + MESSAGE_RECEIVED_TEXT_2)
     else:
-        message = core.user_input()
+        # Blocks until a line is entered
+        message = core.user_input(None)
 
     return message.strip()
 
@@ -91,11 +150,9 @@ def _receive_telegram_bot() -> str:
 
     try:
         if len(telegram_message_queue) == 0:
-            time.sleep(TELEGRAM_PLUGIN_RECEIVE_WAIT_TIME)
-
             bot = telegram_bot.TelegramBot(TELEGRAM_BOT_TOKEN, TELEGRAM_USER_ID)
 
-            # Fetch pending messages
+            # Fetch pending messages (long polling, returns as soon as a message arrives)
             message_list = asyncio.run(bot.receive())
 
             # Append pending messages to message queue
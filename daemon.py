@@ -0,0 +1,246 @@
+import os
+import sys
+import codecs
+import queue
+import select
+import socket
+import socketserver
+import struct
+import threading
+from collections.abc import Callable
+from typing import Any, TextIO
+import core
+
+DAEMON_TEXT = "\nMAGI daemon listening on "
+DAEMON_NOT_RUNNING_ERROR = "\n[ERROR] The MAGI daemon is not running: "
+DAEMON_RUNNING_ERROR = "\n[ERROR] A MAGI daemon is already running on "
+DAEMON_CLOSED_TEXT = "\n\nThe MAGI daemon stopped.\n"
+DETACHED_TEXT = "\n\nDetached from the MAGI daemon.\n"
+CLIENT_TAG = "\n[CLIENT] "
+DETACH_COMMAND = "EXIT"  # Typed in a client, it detaches instead of stopping MAGI
+STOP_COMMAND = "SHUTDOWN"  # Typed in a client, it stops MAGI
+EXIT_INPUT = "EXIT"  # Exit command of MAGI, sent as user input to stop it
+CLIENT_SEND_TIMEOUT = 5  # Seconds, clients that do not read are detached
+CLIENT_QUEUE_SIZE = 1024  # Pending writes of a client, slower clients are detached so they never block the output
+RECEIVE_SIZE = 65536
+
+
+class DaemonOutput:
+    # Console output of the daemon, sent to the attached clients and kept for the ones that attach later
+    def __init__(self, console: TextIO, replay_size: int) -> None:
+        self.console = console
+        self.replay_size = replay_size
+        self.replay = ""
+        self.clients: dict[socket.socket, queue.Queue[bytes | None]] = {}
+        self.lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        data = text.encode('utf-8')
+
+        with self.lock:
+            self.replay = (self.replay + text)[-self.replay_size:] if self.replay_size > 0 else ""
+
+            # Each client has its own writer thread, the output never waits for a socket
+            for client, pending in list(self.clients.items()):
+                try:
+                    pending.put_nowait(data)
+
+                except queue.Full:
+                    del self.clients[client]
+                    _disconnect(client)
+
+            try:
+                self.console.write(text)
+
+            except (OSError, ValueError):
+                # The terminal of the daemon was closed
+                pass
+
+        return len(text)
+
+    def flush(self) -> None:
+        try:
+            self.console.flush()
+
+        except (OSError, ValueError):
+            pass
+
+    def isatty(self) -> bool:
+        # No typewriter effect for the clients
+        return False
+
+    def attach(self, client: socket.socket) -> None:
+        pending: queue.Queue[bytes | None] = queue.Queue(CLIENT_QUEUE_SIZE)
+
+        with self.lock:
+            pending.put_nowait(self.replay.encode('utf-8'))
+            self.clients[client] = pending
+
+        threading.Thread(target = self._send_loop, args = (client, pending), daemon = True).start()
+
+    def detach(self, client: socket.socket) -> None:
+        with self.lock:
+            pending = self.clients.pop(client, None)
+
+        if pending is not None:
+            try:
+                pending.put_nowait(None)
+
+            except queue.Full:
+                _disconnect(client)
+
+    def _send_loop(self, client: socket.socket, pending: queue.Queue[bytes | None]) -> None:
+        # Send the output of one client in order, until it is detached
+        while (data := pending.get()) is not None:
+            try:
+                client.sendall(data)
+
+            except OSError:
+                self.detach(client)
+                _disconnect(client)
+                return
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Clients attach to the running MAGI, their lines are user input
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, output: DaemonOutput, receive_input: Callable[[str], None]) -> None:
+        self.output = output
+        self.receive_input = receive_input
+
+        # Remove the socket of a previous daemon that stopped
+        if os.path.exists(socket_path):
+            if is_running(socket_path):
+                raise FileExistsError(DAEMON_RUNNING_ERROR + socket_path)
+
+            os.remove(socket_path)
+
+        super().__init__(socket_path, DaemonClient)
+
+
+class DaemonClient(socketserver.StreamRequestHandler):
+    server: DaemonServer
+
+    def handle(self) -> None:
+        # Only sends time out, clients stay attached while they are idle
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack('ll', CLIENT_SEND_TIMEOUT, 0))
+
+        try:
+            self.server.output.attach(self.connection)
+
+            for line in self.rfile:
+                message = line.decode('utf-8', errors = 'replace').strip()
+
+                if message:
+                    core.print_system_text(CLIENT_TAG + message)
+                    self.server.receive_input(EXIT_INPUT if message.upper() == STOP_COMMAND else message)
+
+        except OSError:
+            pass
+
+        finally:
+            self.server.output.detach(self.connection)
+
+
+def _disconnect(client: socket.socket) -> None:
+    # The client handler reads the end of the connection and detaches
+    try:
+        client.shutdown(socket.SHUT_RDWR)
+
+    except OSError:
+        pass
+
+
+def is_running(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(socket_path)
+            return True
+
+        except OSError:
+            return False
+
+
+def start(receive_input: Callable[[str], None]) -> DaemonServer:
+    output = DaemonOutput(sys.stdout, core.DAEMON_REPLAY_SIZE)
+
+    try:
+        server = DaemonServer(core.DAEMON_SOCKET, output, receive_input)
+
+    except OSError as e:
+        core.print_system_text(str(e))
+        exit()
+
+    # The console output goes to the clients, the daemon keeps printing it to its own stdout
+    sys.stdout = output  # type: ignore[assignment]
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    core.print_system_text(DAEMON_TEXT + core.DAEMON_SOCKET)
+
+    return server
+
+
+def attach(socket_path: str, stdin: Any = None, stdout: Any = None) -> int:
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+
+    # The input is read from the file descriptor, a buffered file could hold typed lines that select never reports
+    input_fd = stdin.fileno()
+    input_decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+    input_text = ""
+
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+
+    except OSError as e:
+        stdout.write(DAEMON_NOT_RUNNING_ERROR + str(e) + "\n")
+        return 1
+
+    # Output of the daemon and input lines of the user, until either side leaves
+    with connection:
+        try:
+            while True:
+                ready, _, _ = select.select([connection, input_fd], [], [])
+
+                if connection in ready:
+                    data = connection.recv(RECEIVE_SIZE)
+
+                    if not data:
+                        stdout.write(DAEMON_CLOSED_TEXT)
+                        return 0
+
+                    stdout.write(decoder.decode(data))
+                    stdout.flush()
+
+                if input_fd in ready:
+                    data = os.read(input_fd, RECEIVE_SIZE)
+                    lines = (input_text + input_decoder.decode(data, final = not data)).split("\n")
+                    input_text = lines.pop()
+
+                    # The last line of a closed input has no line break
+                    if not data and input_text:
+                        lines.append(input_text)
+
+                    if not _send_lines(connection, lines) or not data:
+                        break
+
+        except KeyboardInterrupt:
+            pass
+
+    stdout.write(DETACHED_TEXT)
+
+    return 0
+
+
+def _send_lines(connection: socket.socket, lines: list[str]) -> bool:
+    for line in lines:
+        if line.strip().upper() == DETACH_COMMAND:
+            return False
+
+        connection.sendall((line + "\n").encode('utf-8'))
+
+    return True
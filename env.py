@@ -0,0 +1,4 @@
+# Environment variables read by core when it is imported, magi sets them before it imports core
+
+MODEL_SERVER_PROCESS_ENV = "MAGI_MODEL_SERVER"  # Set in the model server process, which loads the models itself
+MODEL_LOAD_DEFERRED_ENV = "MAGI_DEFER_MODEL_LOAD"  # Set by the MAGI startup pipeline, which loads the models concurrently with other stages
@@ -8,10 +8,12 @@ Description : AI system
 =====================================================================================
 '''
 
+import os
 import re
+import sys
 import time
 from enum import Enum
-from typing import Any
+from typing import Any, Callable
 
 # MAGI modules
 core: Any = None
@@ -19,7 +21,7 @@ comms: Any = None
 toolchain: Any = None
 agent: Any = None
 
-SYSTEM_HINT_TEXT = "\n\nHint: to switch AI mode, type the letter 'm' and press enter. To exit MAGI, type 'exit'.\n"
+SYSTEM_HINT_TEXT = "\n\nHint: to switch AI mode, type the letter 'm' and press enter. To display performance statistics, type 'stats'. To exit MAGI, type 'exit'.\n"
 CORE_PROTOCOL_TEXT = "\n\n----- Core Protocol -----\n\n"
 PRIME_DIRECTIVES_TEXT = "\n\n----- Prime Directives -----\n\n"
 MISSION_DATA_TEXT = "\n\n----- Mission Data -----\n\n"
@@ -27,6 +29,7 @@ DATA_TEXT = "\n\nDATA = "
 MISSION_TEXT = "\n\nMISSION = "
 GENERATE_TASK_LIST_TEXT = "You have to break down the mission provided in the MISSION section into a list of specific and detailed tasks. Use the DATA section only if it provides useful information for the MISSION. Ensure each task is actionable, detailed, and written in a clear, self-contained manner. Each task must be long enough to convey its purpose fully, but it must fit on a single paragraph. Write each task on its own paragraph, separated by a blank line. Plan as if all needed execution capabilities are available; do not exclude or limit tasks based on assumed inability. Output ONLY the tasks, no reasoning, no commentary, no preamble."
 EXIT_MAGI_TEXT = "\nまたね。\n"
+JOB_CANCELLED_TEXT = "\n[WARNING] The current job was cancelled by new input."
 SUMMARY_TEXT = "\n\n----- Summary -----\n\n"
 ACTIONS_TEXT = "\n\n----- Actions -----\n\n"
 PROGRESS_REPORT_TEXT = "\n\n----- Progress Report -----\n\n"
@@ -34,7 +37,7 @@ ACTION_TAG = "\n[ACTION] "
 NORMAL_MODE_TEXT = "\n««««« NORMAL MODE »»»»»"
 MISSION_MODE_TEXT = "\n««««« MISSION MODE »»»»»"
 NERV_MODE_TEXT    = "\n««««« NERV MODE »»»»»"
-MAGI_MODE_TEXT    = "\n««««« MAGI MODE »»»»»\n\nThis is a fully autonomous mode.\n\nMAGI will run continuously until you manually stop it by pressing Ctrl + C."
+MAGI_MODE_TEXT    = "\n««««« MAGI MODE »»»»»\n\nThis is a fully autonomous mode.\n\nMAGI will run continuously until you send a new message or manually stop it by pressing Ctrl + C."
 MAGI_ACTION_PROMPT = """\n\nYou are in fully autonomous mode. Make continuous, valuable progress on the mission without any human help.
 Review the previous response and conversation history in the context of the overall mission.
 
@@ -155,8 +158,27 @@ EXAMPLES:
   - [Instruction: <clear and specific instruction>]
   - {HEARTBEAT_IDLE_TEXT}
 - Nothing else after </think>."""
+# One-line answer contracts (GBNF)
+MAGI_ACTION_GRAMMAR = 'root ::= ("EXPLOIT" | "EXPLORE") ": " [^\\n]+'
+HEARTBEAT_GRAMMAR = f'root ::= "{HEARTBEAT_IDLE_TEXT}" | "[Instruction: " [^\\]\\n]+ "]"'
 SWITCH_AI_MODE_COMMAND = "M"
+STATS_COMMAND = "STATS"
 EXIT_COMMAND = "EXIT"
+TUNE_OPTION = "--tune"
+SERVER_OPTION = "--server"
+API_OPTION = "--api"
+DAEMON_OPTION = "--daemon"
+ATTACH_OPTION = "--attach"
+PROFILE_OPTION = "--profile"
+IMPORT_TIME_OPTION = "importtime"
+IMPORT_TIME_PREFIX = "import time:"
+PROFILE_IMPORTS = 15  # Slowest top-level imports shown by the startup profile
+STARTUP_IMPORTS_TEXT = "\nSlowest imports, cumulative (ms):\n"
+CONFIG_STAGE = "config"
+MODEL_STAGE = "model load"
+WARMUP_STAGE = "warm-up"
+MODULES_STAGE = "modules and plugins"
+STAGE_FAILED_ERROR = "\n[ERROR] Startup stage failed, it is retried on first use: "
 
 
 _nerv_data: str = ""
@@ -177,7 +199,7 @@ def sanitizeTask(task: str) -> str:
 
 def createTaskList(primeDirectives: str, mission: str, summary: str, header: str, context: list[str]) -> list[str]:
     prompt = GENERATE_TASK_LIST_TEXT + DATA_TEXT + summary + MISSION_TEXT + mission
-    taskListText = core.send_prompt(primeDirectives, prompt, context, hide_reasoning = True)
+    taskListText = core.send_prompt(primeDirectives, prompt, context, hide_reasoning = True, call_type = core.CALL_TYPE_TASK)
     comms.printSystemText(header + taskListText + "\n")
     # Remove blank lines and create the task list
     taskList = [line for line in taskListText.splitlines() if line.strip()]
@@ -190,7 +212,7 @@ def computeMagiAction(primeDirectives: str, mission: str, progress_report: str,
     else:
         briefing = MISSION_TEXT + mission + MAGI_ACTION_PROMPT
 
-    action = core.send_prompt(primeDirectives, briefing, context, hide_reasoning = True)
+    action = core.send_prompt(primeDirectives, briefing, context, hide_reasoning = True, call_type = core.CALL_TYPE_TASK, grammar = MAGI_ACTION_GRAMMAR)
 
     return action
 
@@ -259,6 +281,21 @@ def checkPrompt(primeDirectives: str, prompt: str, context: list[str], ai_mode:
         toolchain.runAction(primeDirectives, prompt, context)
 
 
+def runJob(job: Callable[[], Any]) -> Any:
+    # User input received during the job cancels it, and is the next prompt
+    comms.start_job()
+
+    try:
+        return job()
+
+    except core.JobCancelled:
+        comms.printSystemText(JOB_CANCELLED_TEXT)
+        return None
+
+    finally:
+        comms.end_job()
+
+
 def switchAiMode(ai_mode: AiMode) -> AiMode:
     if ai_mode == AiMode.NORMAL:
         ai_mode = AiMode.MISSION
@@ -277,7 +314,7 @@ def switchAiMode(ai_mode: AiMode) -> AiMode:
 
 
 def run_heartbeat(primeDirectives: str, context: list[str]) -> bool:
-    action = core.send_prompt(primeDirectives, HEARTBEAT_PROMPT, context[:], hide_reasoning = True)
+    action = core.send_prompt(primeDirectives, HEARTBEAT_PROMPT, context[:], hide_reasoning = True, call_type = core.CALL_TYPE_TASK, grammar = HEARTBEAT_GRAMMAR)
 
     if action and HEARTBEAT_IDLE_TEXT not in action:
         toolchain.runAction(primeDirectives, action, context)
@@ -286,8 +323,65 @@ def run_heartbeat(primeDirectives: str, context: list[str]) -> bool:
     return False
 
 
+def profile_startup() -> int:
+    import subprocess
+
+    # Run the startup again with the import time of every module printed to stderr
+    result = subprocess.run([sys.executable, '-X', IMPORT_TIME_OPTION, os.path.abspath(__file__), PROFILE_OPTION], stderr = subprocess.PIPE, text = True, check = False)  # noqa: S603
+    imports = []
+
+    for line in result.stderr.splitlines():
+        if not line.startswith(IMPORT_TIME_PREFIX):
+            print(line, file = sys.stderr)
+            continue
+
+        try:
+            _, cumulative, name = line[len(IMPORT_TIME_PREFIX):].split('|')
+            cumulative_us = int(cumulative)
+
+        except ValueError:
+            # Header line
+            continue
+
+        # Nested imports are indented, their time is included in the top-level ones
+        if not name[1:].startswith(' '):
+            imports.append((cumulative_us, name.strip()))
+
+    print(STARTUP_IMPORTS_TEXT)
+
+    for cumulative_us, name in sorted(imports, reverse = True)[:PROFILE_IMPORTS]:
+        print(f"{cumulative_us / 1000:10.1f}  {name}")
+
+    print(f"{sum(cumulative_us for cumulative_us, _ in imports) / 1000:10.1f}  total")
+
+    return result.returncode
+
+
+def import_core() -> None:
+    global core
+    import core as _core
+    core = _core
+
+
+def import_modules() -> None:
+    # The plugins add their startup stages when they are initialized
+    global comms, toolchain, agent
+    import comms as _comms
+    import toolchain as _toolchain
+    import agent as _agent
+    import plugin  # noqa: F401
+
+    comms, toolchain, agent = _comms, _toolchain, _agent
+
+
+def warm_up(primeDirectives: str) -> None:
+    core.start_warmup(primeDirectives)
+    core.wait_warmup()
+
+
 def print_cli_symbol():
     if not comms.telegram_bot_enabled:
+        core.wait_output()
         print(core.USER_COLOR + "\n$ ", end = '', flush = True)
 
 
@@ -295,22 +389,66 @@ def main() -> int:
     # Import MAGI modules here to prevent them from being imported in subprocesses
     global core, comms, toolchain, agent
 
-    import core as _core
-    import comms as _comms
-    import toolchain as _toolchain
-    import agent as _agent
-    import plugin  # noqa: F401
+    # Profile the startup in a child process with the import times enabled
+    if PROFILE_OPTION in sys.argv[1:] and IMPORT_TIME_OPTION not in sys._xoptions:
+        return profile_startup()
+
+    import env
+
+    # Serve the models to other MAGI instances
+    if SERVER_OPTION in sys.argv[1:]:
+        os.environ[env.MODEL_SERVER_PROCESS_ENV] = "1"
+        import model_server
+        return model_server.main()
+
+    import startup
+
+    # The model loads in the background, concurrently with the other stages (tuning loads its own benchmark models)
+    os.environ[env.MODEL_LOAD_DEFERRED_ENV] = "1"
 
-    core, comms, toolchain, agent = _core, _comms, _toolchain, _agent
+    startup.run_stage(CONFIG_STAGE, import_core)
+
+    # Attach this console to the MAGI daemon (only the config is read, the model is not loaded)
+    if ATTACH_OPTION in sys.argv[1:]:
+        import daemon
+        return daemon.attach(core.DAEMON_SOCKET)
+
+    # Keep MAGI running for the clients that attach to it, from the start so they see the startup output
+    if DAEMON_OPTION in sys.argv[1:]:
+        import daemon
+        import comms as _comms
+
+        _comms.console_input = False
+        daemon.start(_comms.receive_input)
+
+    # Benchmark the runtime parameters of the model and exit
+    if TUNE_OPTION in sys.argv[1:]:
+        core.tune_model()
+        return 0
+
+    # Load, preload and warm up the model while the modules and plugins are initialized
+    primeDirectives = core.read_text_file(core.PRIME_DIRECTIVES_FILE_PATH)
+    model_stage = startup.add_stage(MODEL_STAGE, core.load_model)
+    startup.add_stage(WARMUP_STAGE, lambda: warm_up(primeDirectives), [model_stage])
+    startup.run_stage(MODULES_STAGE, import_modules)
+
+    # Wait until every stage is done
+    for stage in startup.wait_ready():
+        comms.printSystemText(STAGE_FAILED_ERROR + stage.name + ": " + str(stage.error))
+
+    comms.printSystemText(startup.get_timing_text())
+
+    if PROFILE_OPTION in sys.argv[1:]:
+        return 0
 
     context: list[str] = []
-    primeDirectives: str = ""
     ai_mode: AiMode = AiMode.NORMAL
     prompt: str = " "
     prompt_tokens: int = 0
     command: str = ""
     last_heartbeat: float = 0.0
     elapsed_time: float = 0.0
+    timeout: float | None = None
 
     # Initialize heartbeat
     last_heartbeat = time.time()
@@ -319,12 +457,15 @@ def main() -> int:
     if toolchain.core_protocol_text:
         comms.printSystemText(CORE_PROTOCOL_TEXT + toolchain.core_protocol_text)
 
-    # Initialize Prime Directives
-    primeDirectives = core.read_text_file(core.PRIME_DIRECTIVES_FILE_PATH)
-
+    # Display Prime Directives
     if primeDirectives:
         comms.printSystemText(PRIME_DIRECTIVES_TEXT + primeDirectives)
 
+    # Serve the HTTP API instead of the console
+    if API_OPTION in sys.argv[1:]:
+        import api
+        return api.main(primeDirectives)
+
     # Print system hint
     comms.printSystemText(SYSTEM_HINT_TEXT)
 
@@ -340,11 +481,12 @@ def main() -> int:
             last_heartbeat = time.time()
 
             # Print a new CLI symbol if the heartbeat executed an action
-            if run_heartbeat(primeDirectives, context):
+            if runJob(lambda: run_heartbeat(primeDirectives, context)):
                 print_cli_symbol()
 
-        # Check user input
-        prompt = comms.userInput()
+        # Wait for user input until the next heartbeat is due, without polling while idle
+        timeout = max(last_heartbeat + core.HEARTBEAT_SECONDS - time.time(), 0) if core.HEARTBEAT_SECONDS > 0 else None
+        prompt = comms.userInput(timeout)
 
         if not prompt:
             continue
@@ -352,8 +494,8 @@ def main() -> int:
         # Reset heartbeat timer
         last_heartbeat = time.time()
 
-        # Run user prompt
-        prompt_tokens = core.get_number_of_tokens(prompt)
+        # Count the prompt text (the turn that is sent depends on the mode and tools, its tokens are cached then)
+        prompt_tokens = core.count_text_tokens(prompt)
 
         # Check prompt length
         if prompt_tokens > core.MAX_INPUT_TOKENS:
@@ -371,8 +513,10 @@ def main() -> int:
         # Check change AI mode command
         if command.upper() == SWITCH_AI_MODE_COMMAND:
             ai_mode = switchAiMode(ai_mode)
+        elif command.upper() == STATS_COMMAND:
+            comms.printSystemText(core.get_stats_text())
         else:
-            checkPrompt(primeDirectives, prompt, context, ai_mode)
+            runJob(lambda: checkPrompt(primeDirectives, prompt, context, ai_mode))
 
         print_cli_symbol()
 
@@ -0,0 +1,689 @@
+import os
+import json
+import queue
+import codecs
+import inspect
+import contextlib
+import socketserver
+import threading
+import collections
+from typing import Any, Iterator
+import core
+
+MODEL_SERVER_TEXT = "\nModel server listening on "
+MODEL_SERVER_SESSIONS_TEXT = ", sessions: "
+MODEL_SERVER_ROLE_ERROR = "Model role not loaded: "
+MODEL_SERVER_REQUEST_ERROR = "Invalid request: "
+MODEL_SERVER_CONTEXT_ERROR = "Not enough context for the sessions of the model server."
+MODEL_SERVER_BATCH_WARNING = "\n[WARNING] The model server runs one session at a time for the model role "
+BATCH_SUPPORT_ERROR = "unsupported llama_cpp version "
+BATCH_LLAMA_CPP_VERSION = "0.3.43"  # llama-cpp-python version of requirements.txt, the internals below were written against it
+BATCH_INTERNALS = ("LlamaContext", "LlamaBatch", "LlamaSampler")
+BATCH_CONTEXT_METHODS = ("decode", "kv_cache_seq_rm")
+BATCH_SAMPLER_METHODS = ("add_penalties", "add_dry", "add_grammar", "add_greedy", "add_top_k", "add_top_p", "add_min_p", "add_temp", "add_dist", "sample")
+BATCH_LLAMA_ATTRIBUTES = ("_ctx", "_stack", "_model", "_seed", "context_params", "n_batch", "last_n_tokens_size", "verbose")
+BATCH_MODEL_METHODS = ("vocab", "detokenize", "n_ctx_train")
+BATCH_CONTEXT_PARAMS = ("n_ctx", "n_seq_max", "kv_unified")
+BATCH_PENALTY_PARAMS = {"penalty_last_n", "penalty_repeat", "penalty_freq", "penalty_present"}
+CANCEL_OP = "cancel"
+FINISH_REASON_STOP = "stop"
+FINISH_REASON_LENGTH = "length"
+
+
+class LlamaBatchEngine:
+    # Context with one KV cache sequence per session, on the weights of a loaded model
+    def __init__(self, llama: Any, sequences: int) -> None:
+        import llama_cpp
+        from llama_cpp import _internals
+
+        # Checked before the context of the model is replaced
+        check_batch_support(llama_cpp, _internals, llama)
+
+        self.llama = llama
+        self.llama_cpp = llama_cpp
+        self.batch_size: int = llama.n_batch
+
+        # Sessions share the context size of the model, idle sequences are evicted when it is full
+        params = llama_cpp.llama_context_params.from_buffer_copy(llama.context_params)
+        params.n_ctx = llama.n_ctx()
+        params.n_seq_max = sequences
+        params.kv_unified = True
+
+        # The single sequence context of the model is replaced by the batched one
+        llama._ctx.close()
+
+        try:
+            self.context = _internals.LlamaContext(model = llama._model, params = params, verbose = False)
+            self.batch = _internals.LlamaBatch(n_tokens = self.batch_size, embd = 0, n_seq_max = sequences, verbose = False)
+
+        except Exception:
+            # The model gets its own context back and serves one session at a time
+            llama._ctx = llama._stack.enter_context(contextlib.closing(_internals.LlamaContext(model = llama._model, params = llama.context_params, verbose = llama.verbose)))
+            raise
+        self._internals = _internals
+
+    def decode(self, entries: list[tuple[int, list[int], int]]) -> list[int]:
+        # Each entry adds tokens of a sequence from a position, only the last token of an entry computes logits
+        batch = self.batch.batch
+        indices = []
+        n = 0
+
+        for seq_id, tokens, position in entries:
+            for i, token in enumerate(tokens):
+                batch.token[n] = token
+                batch.pos[n] = position + i
+                batch.n_seq_id[n] = 1
+                batch.seq_id[n][0] = seq_id
+                batch.logits[n] = False
+                n += 1
+
+            batch.logits[n - 1] = True
+            indices.append(n - 1)
+
+        batch.n_tokens = n
+        self.context.decode(self.batch)
+
+        return indices
+
+    def clear(self, seq_id: int, position: int) -> None:
+        self.context.kv_cache_seq_rm(seq_id, position, -1)
+
+    def new_sampler(self, kwargs: dict[str, Any]) -> Any:
+        # Same sampler chain as the completions of llama_cpp.Llama
+        sampler = self._internals.LlamaSampler()
+        sampler.add_penalties(penalty_last_n = self.llama.last_n_tokens_size, penalty_repeat = kwargs.get("repeat_penalty", 1.0), penalty_freq = 0.0, penalty_present = kwargs.get("present_penalty", 0.0))
+
+        if kwargs.get("dry_multiplier"):
+            sampler.add_dry(self.llama._model, self.llama._model.n_ctx_train(), kwargs["dry_multiplier"], kwargs.get("dry_base", 1.75), kwargs.get("dry_allowed_length", 2), kwargs.get("dry_penalty_last_n", 0), kwargs.get("dry_seq_breakers", []))
+
+        if kwargs.get("grammar") is not None:
+            sampler.add_grammar(self.llama._model, kwargs["grammar"])
+
+        temperature = kwargs.get("temperature", 0.8)
+
+        if temperature == 0.0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(kwargs.get("top_k", 40))
+            sampler.add_top_p(kwargs.get("top_p", 0.95), 1)
+            sampler.add_min_p(kwargs.get("min_p", 0.05), 1)
+            sampler.add_temp(temperature)
+            sampler.add_dist(self.llama._seed)
+
+        return sampler
+
+    def sample(self, sampler: Any, index: int) -> int:
+        token: int = sampler.sample(self.context, index)
+
+        return token
+
+    def is_end(self, token: int) -> bool:
+        return bool(self.llama_cpp.llama_vocab_is_eog(self.llama._model.vocab, token))
+
+    def token_bytes(self, token: int) -> bytes:
+        piece: bytes = self.llama._model.detokenize([token])
+
+        return piece
+
+
+def check_batch_support(llama_cpp: Any, internals: Any, llama: Any) -> None:
+    # The batch engine builds on llama_cpp internals, other versions fall back to one session at a time
+    sampler = getattr(internals, "LlamaSampler", None)
+    context_params = {field[0] for field in getattr(getattr(llama_cpp, "llama_context_params", None), "_fields_", [])}
+
+    missing = [name for name in BATCH_INTERNALS if not hasattr(internals, name)]
+    missing += [name for name in BATCH_CONTEXT_METHODS if not hasattr(getattr(internals, "LlamaContext", None), name)]
+    missing += [name for name in BATCH_SAMPLER_METHODS if not hasattr(sampler, name)]
+    missing += [name for name in BATCH_LLAMA_ATTRIBUTES if not hasattr(llama, name)]
+    missing += [name for name in BATCH_MODEL_METHODS if not hasattr(getattr(llama, "_model", None), name)]
+    missing += [name for name in BATCH_CONTEXT_PARAMS if name not in context_params]
+    missing += [] if hasattr(llama_cpp, "llama_vocab_is_eog") else ["llama_vocab_is_eog"]
+    missing += [] if str(getattr(llama_cpp, "__version__", "")).startswith(BATCH_LLAMA_CPP_VERSION) else ["version " + BATCH_LLAMA_CPP_VERSION]
+
+    # Older samplers take the vocabulary and token ids as well
+    if hasattr(sampler, "add_penalties"):
+        params = inspect.signature(sampler.add_penalties).parameters
+        required = {name for name, param in params.items() if name != "self" and param.default is param.empty}
+
+        if not required <= BATCH_PENALTY_PARAMS or not BATCH_PENALTY_PARAMS <= set(params):
+            missing.append("add_penalties(" + ", ".join(params) + ")")
+
+    if missing:
+        raise RuntimeError(BATCH_SUPPORT_ERROR + str(getattr(llama_cpp, "__version__", "")) + ": " + ", ".join(missing))
+
+
+class Sequence:
+    # KV cache sequence of the batched context, kept by its last session while idle
+    def __init__(self, seq_id: int) -> None:
+        self.seq_id = seq_id
+        self.tokens: list[int] = []
+        self.owner: Any = None
+        self.last_used = 0
+
+
+class Completion:
+    # Completion of a session, evaluated and generated in a sequence of the scheduler
+    def __init__(self, session: Any, tokens: list[int], max_tokens: int, sampler: Any, stop: list[str]) -> None:
+        self.session = session
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.sampler = sampler
+        self.stop = stop
+        self.sequence: Sequence | None = None
+        self.pending: list[int] = []
+        self.generated = 0
+        self.text = ""
+        self.sent = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+        self.chunks: queue.Queue[dict[str, Any] | None] = queue.Queue()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.error = ""
+
+
+class BatchScheduler:
+    # Continuous batching: every forward pass evaluates one token of each generating session and prompt chunks of the rest
+    def __init__(self, engine: Any, sequences: int) -> None:
+        self.engine = engine
+        self.sequences = [Sequence(seq_id) for seq_id in range(sequences)]
+        self.waiting: collections.deque[Completion] = collections.deque()
+        self.active: list[Completion] = []
+        self.condition = threading.Condition()
+        self.turn = 0
+        self.steps = 0
+        self.running = True
+
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def submit(self, session: Any, tokens: list[int], max_tokens: int, kwargs: dict[str, Any]) -> Completion:
+        completion = Completion(session, tokens, max_tokens, self.engine.new_sampler(kwargs) if max_tokens > 0 else None, kwargs.get("stop") or [])
+
+        # Sessions beyond the limit wait in arrival order
+        with self.condition:
+            self.waiting.append(completion)
+            self.condition.notify()
+
+        return completion
+
+    def stream(self, completion: Completion) -> Iterator[dict[str, Any]]:
+        try:
+            while (chunk := completion.chunks.get()) is not None:
+                yield chunk
+
+            if completion.error:
+                raise RuntimeError(completion.error)
+        finally:
+            completion.cancelled.set()
+
+            with self.condition:
+                self.condition.notify()
+
+            completion.done.wait()
+
+    def cancel(self, completion: Completion) -> None:
+        # Seen before the next forward pass, also while the prompt is evaluated
+        with self.condition:
+            completion.cancelled.set()
+            self.condition.notify()
+
+    def input_ids(self, session: Any) -> list[int]:
+        with self.condition:
+            sequence = self._session_sequence(session)
+
+            return list(sequence.tokens) if sequence else []
+
+    def reset(self, session: Any) -> None:
+        with self.condition:
+            sequence = self._session_sequence(session)
+
+            if sequence and not any(completion.sequence is sequence for completion in self.active):
+                self.engine.clear(sequence.seq_id, 0)
+                sequence.tokens = []
+
+    def release(self, session: Any) -> None:
+        # Closed sessions leave their sequence to any other session
+        with self.condition:
+            sequence = self._session_sequence(session)
+
+            if sequence:
+                sequence.owner = None
+
+    def close(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.thread.join()
+
+    def _session_sequence(self, session: Any) -> Sequence | None:
+        return next((sequence for sequence in self.sequences if sequence.owner is session), None)
+
+    def _admit(self) -> None:
+        busy = {id(completion.sequence) for completion in self.active}
+
+        while self.waiting and len(self.active) < len(self.sequences):
+            completion = self.waiting.popleft()
+            free = [sequence for sequence in self.sequences if id(sequence) not in busy]
+
+            # The session keeps its own sequence, otherwise the least recently used one is taken
+            sequence = self._session_sequence(completion.session)
+
+            if sequence is None or id(sequence) in busy:
+                sequence = min(free, key = lambda sequence: (sequence.owner is not None, sequence.last_used))
+
+            # Reuse the common prefix, the last prompt token is evaluated again to sample from its logits
+            keep = core._prefix_length(sequence.tokens, completion.tokens)
+
+            if keep == len(completion.tokens) and completion.max_tokens > 0:
+                keep -= 1
+
+            keep = max(keep, 0)
+            self.engine.clear(sequence.seq_id, keep)
+            sequence.tokens = sequence.tokens[:keep]
+            sequence.owner = completion.session
+
+            completion.sequence = sequence
+            completion.pending = completion.tokens[keep:]
+            busy.add(id(sequence))
+            self.active.append(completion)
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and not self.waiting and not self.active:
+                    self.condition.wait()
+
+                if not self.running:
+                    return
+
+                for completion in [completion for completion in self.active if completion.cancelled.is_set()]:
+                    self._finish(completion, FINISH_REASON_STOP)
+
+                self._admit()
+
+                try:
+                    self._step()
+
+                except Exception as e:
+                    for completion in list(self.active):
+                        completion.error = str(e)
+                        self._finish(completion, FINISH_REASON_STOP)
+
+    def _step(self) -> None:
+        # Generating sessions add their last sampled token, prompts share the rest of the batch
+        generating = [completion for completion in self.active if len(completion.pending) == 1]
+        prefilling = [completion for completion in self.active if len(completion.pending) > 1 and not completion.cancelled.is_set()]
+        entries = [(completion, completion.pending) for completion in generating]
+        budget = self.engine.batch_size - len(entries)
+
+        # Prompts share the batch evenly, shorter ones leave their unused share to the rest
+        if prefilling:
+            start = self.turn % len(prefilling)
+            prefilling = sorted(prefilling[start:] + prefilling[:start], key = lambda completion: len(completion.pending))
+            self.turn += 1
+
+        for i, completion in enumerate(prefilling):
+            if budget <= 0:
+                break
+
+            size = min(len(completion.pending), max(budget // (len(prefilling) - i), 1))
+            entries.append((completion, completion.pending[:size]))
+            budget -= size
+
+        # Prompts already evaluated by an earlier completion only finish
+        for completion in [completion for completion in self.active if not completion.pending]:
+            self._finish(completion, FINISH_REASON_STOP)
+
+        if not entries:
+            return
+
+        indices = self._decode(entries)
+        self.steps += 1
+
+        for (completion, tokens), index in zip(entries, indices):
+            sequence = completion.sequence
+            sequence.tokens += tokens
+            sequence.last_used = self.steps
+            completion.pending = completion.pending[len(tokens):]
+
+            if completion.pending:
+                continue
+
+            if completion.max_tokens <= 0:
+                self._finish(completion, FINISH_REASON_STOP)
+                continue
+
+            self._accept(completion, self.engine.sample(completion.sampler, index))
+
+    def _decode(self, entries: list[tuple[Completion, list[int]]]) -> list[int]:
+        batch = [(completion.sequence.seq_id, tokens, len(completion.sequence.tokens)) for completion, tokens in entries]
+
+        try:
+            indices: list[int] = self.engine.decode(batch)
+
+        except RuntimeError:
+            # Free the context of idle sessions and try again
+            busy = {id(completion.sequence) for completion in self.active}
+            idle = [sequence for sequence in self.sequences if id(sequence) not in busy and sequence.tokens]
+
+            if not idle:
+                raise RuntimeError(MODEL_SERVER_CONTEXT_ERROR)
+
+            for sequence in idle:
+                self.engine.clear(sequence.seq_id, 0)
+                sequence.tokens = []
+
+            indices = self.engine.decode(batch)
+
+        return indices
+
+    def _accept(self, completion: Completion, token: int) -> None:
+        if self.engine.is_end(token):
+            self._finish(completion, FINISH_REASON_STOP)
+            return
+
+        completion.generated += 1
+        completion.text += completion.decoder.decode(self.engine.token_bytes(token))
+
+        # Stop strings are not sent
+        for stop in completion.stop:
+            position = completion.text.find(stop, max(completion.sent - len(stop), 0))
+
+            if position >= 0:
+                completion.text = completion.text[:position]
+                self._finish(completion, FINISH_REASON_STOP)
+                return
+
+        if completion.generated >= completion.max_tokens:
+            self._finish(completion, FINISH_REASON_LENGTH)
+            return
+
+        # Text that could be the start of a stop string is held back
+        held = max((len(stop) - 1 for stop in completion.stop), default = 0)
+        self._send(completion, len(completion.text) - held, None)
+        completion.pending = [token]
+
+    def _send(self, completion: Completion, end: int, finish_reason: str | None) -> None:
+        if end > completion.sent or finish_reason:
+            completion.chunks.put({"choices": [{"text": completion.text[completion.sent:end], "index": 0, "finish_reason": finish_reason}]})
+            completion.sent = max(end, completion.sent)
+
+    def _finish(self, completion: Completion, finish_reason: str) -> None:
+        if not completion.error:
+            self._send(completion, len(completion.text), finish_reason)
+
+        completion.chunks.put(None)
+        completion.done.set()
+        self.active.remove(completion)
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # One memory-mapped model per role, shared by the sessions of every connected MAGI instance
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, models: dict[str, Any], model_files: dict[str, str], sessions: int = 1) -> None:
+        self.models = models
+        self.model_files = model_files
+        self.model_lock = threading.Lock()
+
+        # With several sessions, completions of every role are batched by its scheduler
+        self.schedulers: dict[str, BatchScheduler] = {}
+
+        if sessions > 1:
+            for role, model in models.items():
+                try:
+                    self.schedulers[role] = BatchScheduler(LlamaBatchEngine(model, sessions), sessions)
+
+                except Exception as e:
+                    core.print_system_text(MODEL_SERVER_BATCH_WARNING + role + ": " + str(e))
+
+        # Session whose state is loaded in each model
+        self.owners: dict[str, "ModelSession"] = {}
+
+        # Remove the socket of a previous server
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        super().__init__(socket_path, ModelSession)
+
+    def server_close(self) -> None:
+        super().server_close()
+
+        for scheduler in self.schedulers.values():
+            scheduler.close()
+
+
+class ModelSession(socketserver.StreamRequestHandler):
+    # Connection of a MAGI instance to a model, with its own model state
+    server: ModelServer
+
+    def setup(self) -> None:
+        super().setup()
+        self.role = core.MODEL_MAIN
+        self.state: Any = None
+
+        # Request lines, read by one thread so cancels are seen while a completion runs
+        self.requests: queue.Queue[bytes] = queue.Queue()
+        self.cancelled = threading.Event()
+        self.completion: Completion | None = None
+        threading.Thread(target = self._read, daemon = True).start()
+
+    def _read(self) -> None:
+        try:
+            for line in self.rfile:
+                if _is_cancel(line):
+                    self._cancel()
+                else:
+                    self.requests.put(line)
+
+        except (OSError, ValueError):
+            pass
+
+        finally:
+            # End of the connection
+            self._cancel()
+            self.requests.put(b"")
+
+    def _cancel(self) -> None:
+        # Stops the running completion at once, even while its prompt is evaluated
+        self.cancelled.set()
+        completion = self.completion
+        scheduler = self.server.schedulers.get(self.role)
+
+        if completion is not None and scheduler is not None:
+            scheduler.cancel(completion)
+
+    def handle(self) -> None:
+        try:
+            while line := self.requests.get():
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    self._send({"error": MODEL_SERVER_REQUEST_ERROR + str(e)})
+                    continue
+
+                # A late cancel of a stream that already ended was read before this request
+                self.cancelled.clear()
+
+                # Batched roles run the sessions at the same time, the rest one at a time
+                with self.server.model_lock if self.role not in self.server.schedulers else contextlib.nullcontext():
+                    try:
+                        self._dispatch(request)
+                    except Exception as e:
+                        self._send({"error": str(e)})
+                    finally:
+                        self.completion = None
+        finally:
+            # Other sessions don't need to save the state of a closed session
+            with self.server.model_lock:
+                if self.server.owners.get(self.role) is self:
+                    del self.server.owners[self.role]
+
+            for scheduler in self.server.schedulers.values():
+                scheduler.release(self)
+
+    def _send(self, response: dict[str, Any]) -> None:
+        self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+    def _activate(self) -> Any:
+        model = self.server.models[self.role]
+        owner = self.server.owners.get(self.role)
+
+        # Swap the model state of the previous session for the state of this one
+        if owner is not self:
+            if owner is not None:
+                owner.state = model.save_state()
+
+            if self.state is not None:
+                model.load_state(self.state)
+            else:
+                model.reset()
+
+            self.server.owners[self.role] = self
+
+        return model
+
+    def _input_ids(self) -> list[int]:
+        scheduler = self.server.schedulers.get(self.role)
+
+        if scheduler:
+            return scheduler.input_ids(self)
+
+        model = self.server.models[self.role]
+
+        return [int(token) for token in model.input_ids[:model.n_tokens]]
+
+    def _dispatch(self, request: dict[str, Any]) -> None:
+        op = request.get("op")
+
+        if op == "hello":
+            role = request.get("role", core.MODEL_MAIN)
+
+            if role not in self.server.models:
+                raise ValueError(MODEL_SERVER_ROLE_ERROR + str(role))
+
+            self.role = role
+            self._send({"model_file": self.server.model_files[role], "roles": list(self.server.models)})
+
+        elif op == "tokenize":
+            model = self.server.models[self.role]
+            tokens = model.tokenize(request["text"].encode('utf-8'), add_bos = request["add_bos"], special = request["special"])
+
+            # Bytes of each token, to split a text by the offsets of its tokens
+            if request.get("lengths"):
+                self._send({"tokens": [int(token) for token in tokens], "lengths": core.get_token_byte_lengths(model, self.server.model_files[self.role], tokens)})
+            else:
+                self._send({"tokens": [int(token) for token in tokens]})
+
+        elif op == "complete":
+            kwargs = request.get("kwargs", {})
+
+            if kwargs.get("grammar"):
+                from llama_cpp import LlamaGrammar
+                kwargs["grammar"] = LlamaGrammar.from_string(kwargs["grammar"], verbose = False)
+
+            if self.role in self.server.schedulers:
+                chunks = self._submit(request["tokens"], kwargs.get("max_tokens") or core.CONTEXT_SIZE, kwargs)
+
+                if request.get("stream"):
+                    self._stream(chunks)
+                else:
+                    self._send({"result": self._collect(chunks), "input_ids": self._input_ids()})
+
+            else:
+                # Generation stops between tokens when the client cancels
+                from llama_cpp import StoppingCriteriaList
+                kwargs["stopping_criteria"] = StoppingCriteriaList([lambda input_ids, logits: self.cancelled.is_set()])
+
+                if request.get("stream"):
+                    self._stream(self._activate()(request["tokens"], stream = True, **kwargs))
+                else:
+                    self._send({"result": self._activate()(request["tokens"], **kwargs), "input_ids": self._input_ids()})
+
+        elif op == "eval":
+            if self.role in self.server.schedulers:
+                self._collect(self._submit(self._input_ids() + request["tokens"], 0, {}))
+            else:
+                self._activate().eval(request["tokens"])
+
+            self._send({"input_ids": self._input_ids()})
+
+        elif op == "reset":
+            if self.role in self.server.schedulers:
+                self.server.schedulers[self.role].reset(self)
+            else:
+                self._activate().reset()
+
+            self._send({"input_ids": self._input_ids()})
+
+        else:
+            raise ValueError(MODEL_SERVER_REQUEST_ERROR + str(op))
+
+    def _submit(self, tokens: list[int], max_tokens: int, kwargs: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        scheduler = self.server.schedulers[self.role]
+
+        self.completion = scheduler.submit(self, tokens, max_tokens, kwargs)
+
+        return scheduler.stream(self.completion)
+
+    def _collect(self, chunks: Any) -> dict[str, Any]:
+        # Completion result of a whole stream
+        text = ""
+        finish_reason = None
+
+        for chunk in chunks:
+            text += chunk['choices'][0]['text']
+            finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+
+        return {"choices": [{"text": text, "index": 0, "finish_reason": finish_reason}]}
+
+    def _stream(self, chunks: Any) -> None:
+        try:
+            for chunk in chunks:
+                self._send({"chunk": chunk})
+
+                # The client closed the stream (one-line answers stop early)
+                if self._cancelled():
+                    break
+        finally:
+            chunks.close()
+
+        self._send({"done": True, "input_ids": self._input_ids()})
+
+    def _cancelled(self) -> bool:
+        # Set by the reader thread, the other request lines stay queued
+        return self.cancelled.is_set()
+
+
+def _is_cancel(line: bytes) -> bool:
+    try:
+        return bool(json.loads(line).get("op") == CANCEL_OP)
+
+    except (ValueError, AttributeError):
+        # Invalid requests are reported by the request loop
+        return False
+
+
+def main() -> int:
+    socket_path = core.MODEL_SERVER or core.MODEL_SERVER_DEFAULT_SOCKET
+
+    # Every routed model loaded by core is served for its role
+    models = {role: slot.model for role, slot in core.model_slots.items()}
+    model_files = {role: slot.model_file for role, slot in core.model_slots.items()}
+
+    # Preload the model files in the background
+    core.start_warmup("")
+
+    with ModelServer(socket_path, models, model_files, core.MODEL_SERVER_SESSIONS) as server:
+        core.print_system_text(MODEL_SERVER_TEXT + socket_path + MODEL_SERVER_SESSIONS_TEXT + str(core.MODEL_SERVER_SESSIONS))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    os.remove(socket_path)
+
+    return 0
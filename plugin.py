@@ -1,13 +1,23 @@
 import os
 import re
+import itertools
+import importlib
+import threading
+from types import ModuleType
+from typing import TYPE_CHECKING
 import core
 import comms
 import toolchain
-from PIL import Image  # noqa: TC002
+import startup
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 PLUGIN_WORKSPACE_FOLDER = "workspace"
 PLUGINS_TEXT = "\n\n----- Plugins -----\n"
 SAVE_FILE_ERROR = "\n[ERROR] An exception occurred while trying to save a file: "
+PLUGIN_PREFETCH_KEY = "PLUGIN_PREFETCH"
+PLUGIN_PREFETCH_ERROR = "\n[ERROR] An exception occurred while trying to prefetch a plugin: "
 
 # WEB PLUGIN
 WEB_SEARCH_PAGE_LIMIT = 5 # Number of web pages per search
@@ -15,6 +25,7 @@ WEB_MAX_SIZE = 45 # Max text blocks per web page
 WEB_PLUGIN_ENABLED_TEXT  = "Web        : enabled"
 WEB_PLUGIN_DISABLED_TEXT = "Web        : disabled"
 ENABLE_WEB_PLUGIN_KEY = "ENABLE_WEB_PLUGIN"
+WEB_PLUGIN_MODULE = "plugins.web.web"  # Imports ddgs and pycurl
 WEB_SEARCH_TOOL_NAME = "web_search"
 WEB_SEARCH_TOOL_DESCRIPTION = """Search the web for current information. This tool extracts text content from web pages and online documents found via web search (HTML, PDF, DOCX, DOC, ODT). Use when needing up-to-date facts, specifically if the request:
 
@@ -36,7 +47,7 @@ Examples:
 TOPIC = python errors → "common python programming bugs fixes"
 TOPIC = japanese festivals → "traditional japanese festivals history celebrations"
 
-Reason step-by-step. Reflect about your reasoning. Then, on the final line, output ONLY the query string. Don't write titles, headings or comments.
+Reason step-by-step. Reflect about your reasoning. Then output ONLY the query string, on a single line. Don't write titles, headings or comments.
 
 TOPIC = """
 WEB_SEARCH_TARGET_SYSTEM_PROMPT = "You are a research manager. Your job is to tell a junior researcher exactly what information to look for."
@@ -44,7 +55,7 @@ WEB_SEARCH_GENERATE_TARGET = """Analyze the USER_REQUEST.
 Define a clear, concise "Extraction Goal" for the summarizer.
 This goal must specify exactly what facts, numbers, or details to extract from the web pages.
 
-Reason step-by-step. Reflect about your reasoning. Then, on the final line, output ONLY the extraction goal string. Don't write titles, headings or comments.
+Reason step-by-step. Reflect about your reasoning. Then output ONLY the extraction goal string, on a single line. Don't write titles, headings or comments.
 
 USER_REQUEST = """
 WEB_SEARCH_REVIEW_1 = """Does the following WEB_SUMMARY provide relevant information for the REQUESTED_GOAL? Reason step-by-step:
@@ -76,6 +87,7 @@ TELEGRAM_USER_ID_KEY = "TELEGRAM_USER_ID"
 IMAGE_GENERATION_PLUGIN_ENABLED_TEXT  = "Image Gen  : enabled"
 IMAGE_GENERATION_PLUGIN_DISABLED_TEXT = "Image Gen  : disabled"
 ENABLE_IMAGE_GENERATION_PLUGIN_KEY = "ENABLE_IMAGE_GENERATION_PLUGIN"
+IMAGE_GENERATION_PLUGIN_MODULE = "plugins.image_generation.image_generation"  # Imports torch and diffusers
 IMAGE_GENERATION_MODEL_KEY = "IMAGE_GENERATION_MODEL"
 IMAGE_GENERATION_LORA_KEY = "IMAGE_GENERATION_LORA"
 IMAGE_GENERATION_TYPE_KEY = "IMAGE_GENERATION_TYPE"
@@ -175,6 +187,8 @@ IMAGE_GENERATION_ERROR = "\n---\n" + IMAGE_GENERATION_TOOL_NAME + ": unable to g
 CODE_RUNNER_PLUGIN_ENABLED_TEXT  = "Code Runner: enabled"
 CODE_RUNNER_PLUGIN_DISABLED_TEXT = "Code Runner: disabled"
 ENABLE_CODE_RUNNER_PLUGIN_KEY = "ENABLE_CODE_RUNNER_PLUGIN"
+CODE_RUNNER_PLUGIN_MODULE = "plugins.code_runner.code_runner"  # Prepares its virtual environment at startup or on the first run
+CODE_RUNNER_STAGE = "code runner venv"
 CODE_RUNNER_TOOL_NAME = "code_runner"
 CODE_RUNNER_TOOL_DESCRIPTION = """Write and run Python code. Use this tool only if the task:
 
@@ -286,6 +300,8 @@ CODE_RUNNER_PROGRAM_OUTPUT_ERROR = "\n\n[ERROR: Program output truncated. Refine
 CODEX_PLUGIN_ENABLED_TEXT  = "Codex      : enabled"
 CODEX_PLUGIN_DISABLED_TEXT = "Codex      : disabled"
 ENABLE_CODEX_PLUGIN_KEY = "ENABLE_CODEX_PLUGIN"
+CODEX_PLUGIN_MODULE = "plugins.codex.codex_operations"  # Loads the bge-m3 embedding model
+CODEX_STAGE = "codex embeddings"
 
 
 # WEB PLUGIN TOOL
@@ -300,7 +316,7 @@ def web_search(primeDirectives: str, action: str, context: list[str]) -> str:
 
     # Compute web search target
     target_prompt = WEB_SEARCH_GENERATE_TARGET + action
-    target = core.send_prompt(WEB_SEARCH_TARGET_SYSTEM_PROMPT, target_prompt, aux_context, hide_reasoning = True)
+    target = core.send_prompt(WEB_SEARCH_TARGET_SYSTEM_PROMPT, target_prompt, aux_context, hide_reasoning = True, call_type = core.CALL_TYPE_WEB, one_line = True)
 
     # Get the last line
     target = target.split('\n')[-1].strip()
@@ -313,7 +329,7 @@ def web_search(primeDirectives: str, action: str, context: list[str]) -> str:
         comms.printSystemText(WEB_SEARCH_TAG + query + "\n\n" + target)
     else:
         # Generate web search query
-        query = core.send_prompt(WEB_SEARCH_SYSTEM_PROMPT, WEB_SEARCH_GENERATE_QUERY + target, aux_context, hide_reasoning = True)
+        query = core.send_prompt(WEB_SEARCH_SYSTEM_PROMPT, WEB_SEARCH_GENERATE_QUERY + target, aux_context, hide_reasoning = True, call_type = core.CALL_TYPE_WEB, one_line = True)
 
         # Remove double quotes
         query = query.replace('"', '')
@@ -324,14 +340,16 @@ def web_search(primeDirectives: str, action: str, context: list[str]) -> str:
         comms.printSystemText(WEB_SEARCH_TAG + query + "\n\n" + target)
 
         # Run the web search
-        urls = web.search(query, WEB_SEARCH_PAGE_LIMIT)
+        urls = load_plugin(WEB_PLUGIN_MODULE).search(query, WEB_SEARCH_PAGE_LIMIT)
 
     for url in urls:
+        core.check_cancelled()
         comms.printSystemText("\n" + url)
-        text = web.scrape(url)
-        blockArray = core.split_text_in_blocks(text)
+        text = load_plugin(WEB_PLUGIN_MODULE).scrape(url)
+        # Blocks are produced lazily, the page is only tokenized up to the block limit
+        blockArray = itertools.islice(core.chunk_text(text), WEB_MAX_SIZE)
 
-        web_summary = core.summarize_block_array(target, blockArray[:WEB_MAX_SIZE])
+        web_summary = core.summarize_block_array(target, blockArray)
 
         if web_summary:
             raw_summary = core.update_summary(target, raw_summary, web_summary)
@@ -366,21 +384,26 @@ def generate_image(primeDirectives: str, action: str, context: list[str]) -> str
 
     # Generate visual description
     aux_context = context[:]
-    image_description = core.send_prompt(primeDirectives, GENERATE_IMAGE_TEXT + extended_action, aux_context, hide_reasoning = True)
+    image_description = core.send_prompt(primeDirectives, GENERATE_IMAGE_TEXT + extended_action, aux_context, hide_reasoning = True, call_type = core.CALL_TYPE_IMAGE)
 
     # Generate image generation prompt
-    image_generation_prompt = core.send_prompt(IMAGE_GENERATION_SYSTEM_PROMPT, GENERATE_IMAGE_PROMPT_TEXT + image_description, [], hide_reasoning = True)
+    image_generation_prompt = core.send_prompt(IMAGE_GENERATION_SYSTEM_PROMPT, GENERATE_IMAGE_PROMPT_TEXT + image_description, [], hide_reasoning = True, call_type = core.CALL_TYPE_IMAGE)
 
     comms.printSystemText(IMAGE_GENERATION_TAG + image_generation_prompt + "\n")
 
-    # Unload main model
-    core.unload_model()
+    image_generation = load_plugin(IMAGE_GENERATION_PLUGIN_MODULE)
+
+    # Keep the models loaded when the image pipeline fits next to them, otherwise free their KV cache or unload them
+    ram_needed, vram_needed = image_generation.get_pipeline_memory(IMAGE_GENERATION_WIDTH, IMAGE_GENERATION_HEIGHT)
+    residency = core.release_model_memory(ram_needed, vram_needed, image_generation.get_free_vram())
 
-    # Generate image
-    image = image_generation.generate_image(image_generation_prompt, IMAGE_GENERATION_NEGATIVE_PROMPT, IMAGE_GENERATION_MODEL, IMAGE_GENERATION_LORA, IMAGE_GENERATION_TYPE, IMAGE_GENERATION_SPECS, IMAGE_GENERATION_WIDTH, IMAGE_GENERATION_HEIGHT)
+    try:
+        # Generate image
+        image = image_generation.generate_image(image_generation_prompt, IMAGE_GENERATION_NEGATIVE_PROMPT, IMAGE_GENERATION_MODEL, IMAGE_GENERATION_LORA, IMAGE_GENERATION_TYPE, IMAGE_GENERATION_SPECS, IMAGE_GENERATION_WIDTH, IMAGE_GENERATION_HEIGHT)
 
-    # Reload main model
-    core.load_model(startup = False)
+    finally:
+        # Restore the freed model memory
+        core.restore_model_memory(residency)
 
     try:
         if image:
@@ -425,13 +448,15 @@ def code_runner_action(primeDirectives: str, action: str, context: list[str], is
 
     # Generate and review code
     while review < CODE_RUNNER_MAX_REVIEWS and not mission_completed:
+        core.check_cancelled()
+
         if review == 0:
             prompt = CODE_RUNNER_GENERATION_TEXT + action
         else:
             prompt = CODE_RUNNER_FIX_PROGRAM_TEXT + program + "\n\n" + lint_output + "\n\n" + program_output + CODE_RUNNER_MISSION_TEXT + action
 
         # Generate the code
-        response = core.send_prompt(system_prompt, prompt, aux_context, hide_reasoning = True)
+        response = core.send_prompt(system_prompt, prompt, aux_context, hide_reasoning = True, call_type = core.CALL_TYPE_CODE)
 
         comms.printSystemText(CODE_RUNNER_TAG + response + "\n")
 
@@ -445,8 +470,9 @@ def code_runner_action(primeDirectives: str, action: str, context: list[str], is
             program = response.strip()
 
         # Run program
+        core.check_cancelled()
         comms.printSystemText(CODE_RUNNER_RUN_PROGRAM_TEXT)
-        lint_output, program_output = code_runner.run_python_code(program)
+        lint_output, program_output = load_plugin(CODE_RUNNER_PLUGIN_MODULE).run_python_code(program)
 
         # Check lint output size
         if len(lint_output) > CODE_RUNNER_LINT_OUTPUT_LIMIT:
@@ -474,6 +500,36 @@ def code_runner_action(primeDirectives: str, action: str, context: list[str], is
     return extended_action
 
 
+# PLUGIN MODULES
+
+# Tools are registered from the names and descriptions above, their modules are imported when a tool is first used
+plugin_modules: list[str] = []
+
+
+def load_plugin(module_name: str) -> ModuleType:
+    # Imports of the same module by the prefetch thread are serialized by the import system
+    return importlib.import_module(module_name)
+
+
+def prepare_code_runner() -> None:
+    # Upgrade or create the virtual environment while the model loads
+    load_plugin(CODE_RUNNER_PLUGIN_MODULE).prepare_venv()
+
+
+def load_codex_embeddings() -> None:
+    # Load the embedding model while the model loads, instead of during the first action
+    load_plugin(CODEX_PLUGIN_MODULE).load_model()
+
+
+def prefetch_plugins() -> None:
+    for module_name in plugin_modules:
+        try:
+            load_plugin(module_name)
+
+        except Exception as e:
+            core.print_system_text(PLUGIN_PREFETCH_ERROR + module_name + ": " + str(e))
+
+
 # INITIALIZE
 
 try:
@@ -485,7 +541,8 @@ try:
 
     # Code Runner plugin
     if core.config.get(ENABLE_CODE_RUNNER_PLUGIN_KEY, '').upper() == "YES":
-        from plugins.code_runner import code_runner
+        plugin_modules.append(CODE_RUNNER_PLUGIN_MODULE)
+        startup.add_stage(CODE_RUNNER_STAGE, prepare_code_runner)
         core.print_system_text(CODE_RUNNER_PLUGIN_ENABLED_TEXT)
         toolchain.add_tool(CODE_RUNNER_TOOL_NAME, CODE_RUNNER_TOOL_DESCRIPTION, code_runner_action)
     else:
@@ -494,6 +551,7 @@ try:
     # Codex plugin
     if core.config.get(ENABLE_CODEX_PLUGIN_KEY, '').upper() == "YES":
         toolchain.codex_enabled = True
+        startup.add_stage(CODEX_STAGE, load_codex_embeddings)
 
         core.print_system_text(CODEX_PLUGIN_ENABLED_TEXT)
     else:
@@ -501,7 +559,7 @@ try:
 
     # Image generation plugin
     if core.config.get(ENABLE_IMAGE_GENERATION_PLUGIN_KEY, '').upper() == "YES":
-        from plugins.image_generation import image_generation
+        plugin_modules.append(IMAGE_GENERATION_PLUGIN_MODULE)
         IMAGE_GENERATION_MODEL = core.config.get(IMAGE_GENERATION_MODEL_KEY, '')
         IMAGE_GENERATION_LORA = core.config.get(IMAGE_GENERATION_LORA_KEY, '')
         IMAGE_GENERATION_TYPE = core.config.get(IMAGE_GENERATION_TYPE_KEY, '')
@@ -528,12 +586,16 @@ try:
 
     # Web plugin
     if core.config.get(ENABLE_WEB_PLUGIN_KEY, '').upper() == "YES":
-        from plugins.web import web
+        plugin_modules.append(WEB_PLUGIN_MODULE)
         core.print_system_text(WEB_PLUGIN_ENABLED_TEXT)
         toolchain.add_tool(WEB_SEARCH_TOOL_NAME, WEB_SEARCH_TOOL_DESCRIPTION, web_search)
     else:
         core.print_system_text(WEB_PLUGIN_DISABLED_TEXT)
 
+    # Import the plugin modules in the background, before their tools are used
+    if core.config.get(PLUGIN_PREFETCH_KEY, '').upper() == "YES":
+        threading.Thread(target = prefetch_plugins, daemon = True).start()
+
 
 except Exception as e:
     print(core.CONFIG_ERROR + str(e) + "\n")
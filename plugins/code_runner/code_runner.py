@@ -15,6 +15,8 @@ PROGRAM_ERROR_TEXT = "\n\nProgram error: "
 PROGRAM_RETURN_CODE_TEXT = "\nReturn code: "
 PACKAGE_LIST_COMMENT = "# pip install "
 
+venv_ready = False
+
 
 def _install_packages(package_list):
     result = subprocess.run([PIP_EXEC_PATH, 'install', '--upgrade'] + package_list, capture_output = True, text = True)
@@ -40,8 +42,28 @@ def _create_venv():
     subprocess.check_call([PIP_EXEC_PATH, 'install', '--quiet', 'ruff'])
 
 
+def prepare_venv():
+    global venv_ready
+
+    # Prepared by the startup pipeline or on the first run, not at import time
+    if venv_ready:
+        return
+
+    # Check Python virtual environment
+    if os.path.exists(VENV_PATH) and os.path.exists(PIP_EXEC_PATH):
+        # Upgrade Ruff
+        subprocess.check_call([PIP_EXEC_PATH, 'install', '--upgrade', '--quiet', 'ruff'])
+    else:
+        # Create new Python virtual environment
+        _create_venv()
+
+    venv_ready = True
+
+
 def run_python_code(program: str):
     try:
+        prepare_venv()
+
         package_list = []
         pip_output = ""
 
@@ -88,6 +110,7 @@ def run_python_code(program: str):
         # Execute program
         program_output_data = subprocess.run(
             [PYTHON_EXEC_PATH, '-c', program],
+            stdin = subprocess.DEVNULL,
             capture_output = True,
             text = True,
             timeout = PROGRAM_TIMEOUT,
@@ -133,14 +156,6 @@ try:
     PIP_EXEC_PATH = os.path.join(VENV_PATH, 'bin', 'pip')
     RUFF_EXEC_PATH = os.path.join(VENV_PATH, 'bin', 'ruff')
 
-    # Check Python virtual environment
-    if os.path.exists(VENV_PATH) and os.path.exists(PIP_EXEC_PATH):
-        # Upgrade Ruff
-        subprocess.check_call([PIP_EXEC_PATH, 'install', '--upgrade', '--quiet', 'ruff'])
-    else:
-        # Create new Python virtual environment
-        _create_venv()
-
 except Exception as e:
     print(CODE_RUNNER_ERROR + str(e))
     raise
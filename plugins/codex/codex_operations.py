@@ -40,6 +40,11 @@ def _get_model():
     return _model
 
 
+def load_model() -> None:
+    """Load the sentence transformer model before the first Codex call."""
+    _get_model()
+
+
 def _embed_single(text: str) -> list:
     """Return normalized embedding for a single text chunk."""
     return _get_model().encode(text, normalize_embeddings=True).tolist()
@@ -15,6 +15,11 @@ GUIDANCE_SCALE = 5.0
 ALGORITHM_TYPE = "dpmsolver++"  # DPM++ 2M Karras
 LORA_SCALE = 0.8
 
+# Projected SDXL footprint
+PIPELINE_WEIGHTS_FP16 = 7 * (1024 ** 3)  # UNet, both text encoders and VAE
+UNET_WEIGHTS_FP16 = 5 * (1024 ** 3)  # Largest module on the GPU with CPU offload
+ACTIVATION_BYTES_PER_PIXEL = 3 * 1024  # Denoising and VAE decoding with classifier-free guidance
+
 
 def _get_repo_files(repo_id: str):
     try:
@@ -129,6 +134,32 @@ def _load_gpu_pipeline(model: str, lora: Optional[str] = None):
     return pipe
 
 
+def get_free_vram() -> int:
+    if not torch.cuda.is_available():
+        return 0
+
+    free_vram, _ = torch.cuda.mem_get_info(0)
+
+    return free_vram
+
+
+def get_pipeline_memory(width: int, height: int) -> tuple[int, int]:
+    """Projected (RAM, VRAM) bytes of the pipeline loaded by _load_gpu_pipeline"""
+    width, height = (width // 8) * 8, (height // 8) * 8
+    activations = width * height * ACTIVATION_BYTES_PER_PIXEL
+
+    if not torch.cuda.is_available():
+        # Float32 weights and activations in RAM
+        return 2 * PIPELINE_WEIGHTS_FP16 + activations, 0
+
+    if torch.cuda.get_device_properties(0).total_memory >= RECOMMENDED_VRAM:
+        # The weights are read into RAM before they are moved to the GPU
+        return PIPELINE_WEIGHTS_FP16, PIPELINE_WEIGHTS_FP16 + activations
+
+    # CPU offload keeps the weights in RAM and one module at a time on the GPU
+    return PIPELINE_WEIGHTS_FP16, UNET_WEIGHTS_FP16 + activations
+
+
 def generate_image(
     prompt: str,
     negative_prompt: str,
@@ -88,5 +88,8 @@ class TelegramBot:
         except Exception as e:
             print(TELEGRAM_PLUGIN_ERROR + str(e))
 
+            # Wait before polling again
+            await asyncio.sleep(TIMEOUT)
+
         return messageList
 
@@ -0,0 +1,89 @@
+import time
+import threading
+from collections.abc import Callable
+
+STARTUP_TEXT = "\n\n----- Startup -----\n"
+STARTUP_TABLE_HEADER = f"{'Stage':<24}{'Start (ms)':>12}{'Time (ms)':>12}"
+STARTUP_READY_TEXT = "Ready"
+
+
+class Stage:
+    # Startup step run in its own thread once the stages it depends on are done
+    def __init__(self, name: str, function: Callable[[], object], after: list["Stage"]) -> None:
+        self.name = name
+        self.function = function
+        self.after = after
+        self.start = 0.0
+        self.end = 0.0
+        self.error: BaseException | None = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+
+    def run(self) -> None:
+        for stage in self.after:
+            stage.done.wait()
+
+        self.start = time.time()
+
+        try:
+            self.function()
+
+        except BaseException as e:
+            # Raised or returned by the readiness barrier in the main thread
+            self.error = e
+
+        finally:
+            self.end = time.time()
+            self.done.set()
+
+
+stages: list[Stage] = []
+start_time: float = time.time()
+
+
+def add_stage(name: str, function: Callable[[], object], after: list[Stage] | None = None) -> Stage:
+    # Runs in the background, concurrently with the stages that do not depend on it
+    stage = Stage(name, function, after or [])
+    stages.append(stage)
+    stage.thread.start()
+
+    return stage
+
+
+def run_stage(name: str, function: Callable[[], object], after: list[Stage] | None = None) -> Stage:
+    # Runs in the calling thread, for stages that print to the console or import modules used by the caller
+    stage = Stage(name, function, after or [])
+    stages.append(stage)
+    stage.run()
+
+    if stage.error is not None:
+        raise stage.error
+
+    return stage
+
+
+def wait_ready() -> list[Stage]:
+    # Readiness barrier before the first prompt
+    for stage in stages:
+        stage.done.wait()
+
+    failed = [stage for stage in stages if stage.error is not None]
+
+    # Fatal errors (exit) stop MAGI, the work of other failed stages is done again when it is used
+    for stage in failed:
+        if not isinstance(stage.error, Exception):
+            raise stage.error
+
+    return failed
+
+
+def get_timing_text() -> str:
+    text = STARTUP_TEXT + "\n" + STARTUP_TABLE_HEADER
+    ready = max((stage.end for stage in stages), default = start_time)
+
+    for stage in sorted(stages, key = lambda stage: stage.start):
+        text += f"\n{stage.name:<24}{(stage.start - start_time) * 1000:>12,.0f}{(stage.end - stage.start) * 1000:>12,.0f}"
+
+    text += f"\n{STARTUP_READY_TEXT:<24}{(ready - start_time) * 1000:>12,.0f}"
+
+    return text
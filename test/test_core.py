@@ -1,39 +1,143 @@
 import unittest
 import sys
+import os
 import types
-from unittest.mock import patch
+import tempfile
+import shutil
+import struct
+import threading
+import json
+import http.client
+import io
+import socket
+import time
+from unittest.mock import ANY, patch
+import startup
 
 # Create a mock for the Llama class that will be imported in core.py
+class MockLlamaState:
+    def __init__(self, input_ids, n_tokens):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        self.scores = None
+        self.llama_state_size = n_tokens
+
+
+class MockLlamaGrammar:
+    def __init__(self, grammar):
+        self.grammar = grammar
+
+    @classmethod
+    def from_string(cls, grammar, verbose=True):
+        return cls(grammar)
+
+
+class MockLlamaPromptLookupDecoding:
+    def __init__(self, max_ngram_size=2, num_pred_tokens=10):
+        self.max_ngram_size = max_ngram_size
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, *args, **kwargs):
+        return []
+
+
 class MockLlama:
     def __init__(self, model_path=None, n_ctx=None, **kwargs):
         self.model_path = model_path
         self.n_ctx = n_ctx
         self.verbose = True
         self.kwargs = kwargs
+        self.input_ids = []
+        self.n_tokens = 0
+        self.prompts = []
 
-    def tokenize(self, text):
+    def tokenize(self, text, add_bos=True, special=False):
         # Simple mock tokenizer that counts characters as tokens
         return [ord(c) for c in text.decode('utf-8')]
 
+    def detokenize(self, tokens, prev_tokens=None, special=False):
+        return "".join(chr(token) for token in tokens).encode('utf-8')
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def save_state(self):
+        return MockLlamaState(self.input_ids[:], self.n_tokens)
+
+    def load_state(self, state):
+        self.input_ids = state.input_ids[:]
+        self.n_tokens = state.n_tokens
+
     def __call__(self, prompt, max_tokens=100, temperature=1.0, **kwargs):
+        self.prompts.append(prompt)
+
+        # Constrained answers always pick the first choice
+        if kwargs.get('grammar'):
+            output = MOCK_GRAMMAR_OUTPUT
+        else:
+            output = MOCK_MODEL_OUTPUT
+
+        # Cut the output at the first stop string
+        for stop in kwargs.get('stop') or []:
+            output = output.split(stop)[0]
+
+        # Cut the output at the token limit (one token per character)
+        finish_reason = "stop"
+
+        if len(output) > max_tokens:
+            output = output[:max_tokens]
+            finish_reason = "length"
+
+        # The prompt and the generated text are kept in the model state
+        self.input_ids = list(prompt) + self.tokenize(output.encode('utf-8'))
+        self.n_tokens = len(self.input_ids)
+
+        if kwargs.get('stream'):
+            # Yield the output in small chunks, like a streamed completion
+            return ({'choices': [{'text': output[i:i + 5], 'finish_reason': finish_reason if i + 5 >= len(output) else None}]} for i in range(0, len(output), 5))
+
         return {
             'choices': [
-                {'text': MOCK_MODEL_OUTPUT}
+                {'text': output, 'finish_reason': finish_reason}
             ]
         }
 
 # Create and inject the mock llama_cpp module
 mock_llama_cpp = types.ModuleType('llama_cpp')
 setattr(mock_llama_cpp, 'Llama', MockLlama)
+setattr(mock_llama_cpp, 'LlamaGrammar', MockLlamaGrammar)
+setattr(mock_llama_cpp, 'StoppingCriteriaList', list)
 sys.modules['llama_cpp'] = mock_llama_cpp
 
+mock_llama_speculative = types.ModuleType('llama_cpp.llama_speculative')
+setattr(mock_llama_speculative, 'LlamaPromptLookupDecoding', MockLlamaPromptLookupDecoding)
+setattr(mock_llama_cpp, 'llama_speculative', mock_llama_speculative)
+sys.modules['llama_cpp.llama_speculative'] = mock_llama_speculative
+
 # Import core with mocked os.listdir to ensure a model file is found
 with patch('os.listdir', return_value=['model.gguf']):
     import core
+    import model_server
+
+# The HTTP API runs actions through the toolchain, mocked to send the action as a plain prompt
+mock_toolchain = types.ModuleType('toolchain')
+setattr(mock_toolchain, 'runAction', lambda primeDirectives, action, context: core.send_prompt(primeDirectives, action, context, hide_reasoning=True, stream=True))
+
+with patch.dict(sys.modules, {'toolchain': mock_toolchain}):
+    import api
+    import daemon
 
 # Override DISPLAY_EXTENDED_REASONING for all tests
 core.DISPLAY_EXTENDED_REASONING = True
 
+# Run every prompt through the model, without the response cache or reasoning budgets of config.cfg
+core.RESPONSE_CACHE_SIZE = 0
+core.REASONING_BUDGETS = {}
+
 # Test inputs
 PRIME_DIRECTIVES = "You are a friendly AI assistant."
 PROMPT = "Hello, how are you?"
@@ -47,6 +151,7 @@ BASIC_RESPONSE = "I'm a helpful assistant."
 MOCK_MODEL_OUTPUT = "This is a thought.\n</think>\n" + BASIC_RESPONSE
 # What send_prompt actually returns with DISPLAY_EXTENDED_REASONING=True
 NORMAL_RESPONSE = core.THINK_TRIGGER + MOCK_MODEL_OUTPUT
+MOCK_GRAMMAR_OUTPUT = "YES"
 BASIC_MULTIPLE_THINKING_RESPONSE = "Hello there!"
 MULTIPLE_THINKING_RESPONSE = "<think>First thought.</think>\nHello<think>\nAnother thought.\n</think>\n there!"
 PREVIOUS_RESPONSE = "Previous response"
@@ -222,9 +327,11 @@ class TestCore(unittest.TestCase):
         # Save original context
         original_context = context.copy()
 
-        # Add another message via send_prompt, which should trigger trimming
+        # Add another message via send_prompt, which should trigger trimming (compaction disabled)
         third_message = "Third message"
-        response = core.send_prompt(PRIME_DIRECTIVES, third_message, context)
+
+        with patch.object(core, 'COMPACTION_TOKENS', 0):
+            response = core.send_prompt(PRIME_DIRECTIVES, third_message, context)
 
         # Check response
         self.assertEqual(response, NORMAL_RESPONSE)
@@ -248,6 +355,1755 @@ class TestCore(unittest.TestCase):
         self.assertEqual(context[4], BASIC_RESPONSE + core.EOS)
 
 
+class TestPromptCache(unittest.TestCase):
+    def setUp(self):
+        # Set up model instance for testing
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.clear_prompt_cache()
+        core.stats.clear()
+
+        # Save original values to restore after tests
+        self.original_cache_size = core.PROMPT_CACHE_SIZE
+
+    def tearDown(self):
+        # Restore original values after tests
+        core.PROMPT_CACHE_SIZE = self.original_cache_size
+        core.clear_prompt_cache()
+
+    def test_prompt_is_sent_as_tokens(self):
+        """Test the prompt is tokenized once and sent to the model as token ids"""
+        context = []
+
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, context)
+
+        expected_text = core.SYSTEM_TEXT + PRIME_DIRECTIVES + core.EOS + core.USER_TEXT + PROMPT + core.EOS + core.ASSISTANT_TEXT + core.THINK_TRIGGER
+        self.assertEqual(core.model.prompts[-1], core.model.tokenize(expected_text.encode('utf-8')))
+
+    def test_restore_longest_prefix(self):
+        """Test the cached state sharing the longest prefix is restored"""
+        core.PROMPT_CACHE_SIZE = 1000
+
+        context = []
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, context)
+        self.assertEqual(len(core.prompt_cache), 1)
+
+        # A throwaway call with a different system prompt replaces the model state
+        core.send_prompt("Other directives", PROMPT, [])
+        self.assertEqual(len(core.prompt_cache), 2)
+
+        # The next prompt on the original context restores its cached state
+        tokens = core.get_prompt_tokens(context + [core.USER_TEXT + PREVIOUS_PROMPT])
+        cached_tokens = core.restore_prompt_cache(tokens)
+
+        prefix = core.model.tokenize(''.join(context[:2]).encode('utf-8'))
+        self.assertGreaterEqual(cached_tokens, len(prefix))
+        self.assertEqual(core.model.input_ids[:len(prefix)], prefix)
+
+    def test_eviction(self):
+        """Test least recently used states are dropped when the cache is full"""
+        core.PROMPT_CACHE_SIZE = 1
+
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, [])
+
+        self.assertEqual(len(core.prompt_cache), 0)
+        self.assertEqual(core.prompt_cache_bytes, 0)
+
+    def test_disabled_cache(self):
+        """Test no states are kept when the cache is disabled"""
+        core.PROMPT_CACHE_SIZE = 0
+
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, [])
+
+        self.assertEqual(len(core.prompt_cache), 0)
+
+    def test_hit_and_miss_stats(self):
+        """Test hit and miss tokens are counted for every prompt"""
+        context = []
+
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, context)
+        first_miss = core.stats[core.STAT_PROMPT_CACHE_MISS]
+        self.assertEqual(core.stats[core.STAT_PROMPT_CACHE_HIT], 0)
+
+        # The second prompt reuses the evaluated history
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, context)
+        self.assertGreater(core.stats[core.STAT_PROMPT_CACHE_HIT], 0)
+        self.assertIn(core.STAT_PROMPT_CACHE_HIT_RATE, core.get_stats_text())
+
+        total = core.stats[core.STAT_PROMPT_CACHE_HIT] + core.stats[core.STAT_PROMPT_CACHE_MISS]
+        self.assertEqual(total, len(core.model.prompts[0]) + len(core.model.prompts[1]))
+        self.assertGreater(first_miss, 0)
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        # Set up model instance for testing
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.turn_token_cache.clear()
+
+    def test_turns_are_tokenized_once(self):
+        """Test repeated prompts only tokenize the new turns"""
+        context = []
+
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, context)
+
+        with patch.object(core.model, 'tokenize', wraps=core.model.tokenize) as tokenize:
+            core.send_prompt(PRIME_DIRECTIVES, PREVIOUS_PROMPT, context)
+
+        # The previous response, the new user turn, the beginning of sequence lookup and the mock model output
+        self.assertEqual(tokenize.call_count, 4)
+
+    def test_prompt_matches_full_tokenization(self):
+        """Test the assembled prompt tokens match tokenizing the whole prompt text"""
+        context = [core.SYSTEM_TEXT + PRIME_DIRECTIVES + core.EOS, core.USER_TEXT + PROMPT + core.EOS + core.ASSISTANT_TEXT]
+
+        expected = core.model.tokenize((''.join(context) + core.THINK_TRIGGER).encode('utf-8'))
+        self.assertEqual(core.get_prompt_tokens(context), expected)
+
+    def test_cache_limit(self):
+        """Test least recently used turns are dropped when the cache is full"""
+        original_turns = core.TOKEN_CACHE_TURNS
+        core.TOKEN_CACHE_TURNS = 2
+
+        try:
+            for turn in ["a", "b", "c"]:
+                core.get_number_of_tokens(turn)
+
+            self.assertEqual(list(core.turn_token_cache), ["b", "c"])
+        finally:
+            core.TOKEN_CACHE_TURNS = original_turns
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        # Set up model instance for testing
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+
+    def get_rendered_text(self, *args, **kwargs):
+        rendered = []
+
+        with patch.object(core, 'render_text', side_effect=lambda text, typewriter=False: rendered.append(text)):
+            response = core.send_prompt(*args, **kwargs)
+
+        return response, ''.join(rendered)
+
+    def test_stream_matches_response(self):
+        """Test the streamed response is rendered and returned like the full completion"""
+        context = []
+
+        response, rendered = self.get_rendered_text(PRIME_DIRECTIVES, PROMPT, context, stream=True)
+
+        self.assertEqual(response, NORMAL_RESPONSE)
+        self.assertEqual(rendered, core.END_COLOR + core.MAGI_COLOR + "\n" + NORMAL_RESPONSE + core.END_COLOR + "\n")
+        self.assertEqual(context[2], BASIC_RESPONSE + core.EOS)
+
+    def test_stream_hides_reasoning(self):
+        """Test hidden reasoning is never rendered while streaming"""
+        response, rendered = self.get_rendered_text(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True, stream=True)
+
+        self.assertEqual(response, BASIC_RESPONSE)
+        self.assertNotIn("thought", rendered)
+        self.assertIn(BASIC_RESPONSE, rendered)
+
+    def test_stream_constrained_answer(self):
+        """Test the answer of a call with a reasoning budget is rendered while it is generated"""
+        pieces = []
+
+        with patch.object(core, 'REASONING_BUDGETS', {core.CALL_TYPE_CHAT: 1024}):
+            expected = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [])
+
+            with patch.object(core, 'render_stream_text', side_effect=pieces.append):
+                response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], stream=True)
+
+        self.assertEqual(response, expected)
+        self.assertGreater(len([piece for piece in pieces if piece]), 2)
+
+    def test_system_text_does_not_wait(self):
+        """Test system text is queued after the pending response text without waiting for it"""
+        with patch('sys.stdout') as stdout, patch.object(core, 'wait_output') as wait_output:
+            stdout.isatty.return_value = False
+            core.print_magi_text(BASIC_RESPONSE)
+            core.print_system_text(PROMPT)
+
+            wait_output.assert_not_called()
+            core.output_queue.join()
+
+        written = ''.join(call.args[0] for call in stdout.write.call_args_list)
+        self.assertTrue(written.endswith(BASIC_RESPONSE + core.END_COLOR + "\n" + core.END_COLOR + core.SYSTEM_COLOR + PROMPT + core.END_COLOR + "\n"))
+
+    def test_closed_output_does_not_block(self):
+        """Test waiting for the output returns when the output was closed"""
+        with patch('sys.stdout') as stdout:
+            stdout.isatty.return_value = False
+            stdout.write.side_effect = BrokenPipeError
+            core.print_system_text(PROMPT)
+            core.wait_output()
+
+        stdout.write.assert_called_once()
+
+    def test_renderer_output(self):
+        """Test text queued for the renderer is written in order"""
+        with patch('sys.stdout') as stdout:
+            stdout.isatty.return_value = False
+            core.print_magi_text(BASIC_RESPONSE)
+            core.wait_output()
+
+        written = ''.join(call.args[0] for call in stdout.write.call_args_list)
+        self.assertEqual(written, core.END_COLOR + core.MAGI_COLOR + BASIC_RESPONSE + core.END_COLOR + "\n")
+
+
+class TestSpeculativeDecoding(unittest.TestCase):
+    def setUp(self):
+        core.stats.clear()
+
+    def tearDown(self):
+        core.stats.clear()
+
+    def test_acceptance_stats(self):
+        """Test drafted and accepted tokens are counted per call type"""
+        draft = core.SpeculativeDraft(lambda input_ids: [7, 8, 9])
+        draft.begin(core.CALL_TYPE_SUMMARY)
+
+        # First draft, nothing to verify yet
+        draft([1, 2, 3])
+        self.assertEqual(core.stats, {})
+
+        # The model sampled 7 and 8, then rejected 9
+        draft([1, 2, 3, 7, 8, 5])
+
+        self.assertEqual(core.stats["Draft tokens (summary)"], 3)
+        self.assertEqual(core.stats["Draft accepted tokens (summary)"], 2)
+        self.assertIn("Draft acceptance rate (summary): 66.7%", core.get_stats_text())
+
+    def test_pending_draft_is_dropped(self):
+        """Test the unverified draft of a finished completion is not counted"""
+        draft = core.SpeculativeDraft(lambda input_ids: [7, 8, 9])
+
+        draft([1, 2, 3])
+        draft.begin(core.CALL_TYPE_CODEX)
+        draft([4, 5, 6])
+
+        self.assertEqual(core.stats, {})
+
+
+class TestGrammar(unittest.TestCase):
+    def setUp(self):
+        # Set up model instance for testing
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+
+    def test_choice_grammar(self):
+        """Test choices are written as escaped GBNF string literals"""
+        grammar = core.choice_grammar(["TALK 1", "say \"hi\""])
+
+        self.assertEqual(grammar, 'root ::= "TALK 1" | "say \\"hi\\""')
+
+    def test_constrained_answer(self):
+        """Test the answer is generated with the grammar after the reasoning block"""
+        context = []
+
+        response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, context, hide_reasoning=True, choices=core.BINARY_CHOICES)
+
+        self.assertEqual(response, MOCK_GRAMMAR_OUTPUT)
+        self.assertEqual(context[2], MOCK_GRAMMAR_OUTPUT + core.EOS)
+
+        # The answer prompt extends the reasoning prompt with the closed reasoning block
+        reasoning_prompt, answer_prompt = core.model.prompts[-2:]
+        self.assertEqual(answer_prompt[:len(reasoning_prompt)], reasoning_prompt)
+        self.assertEqual(''.join(map(chr, answer_prompt[len(reasoning_prompt):])), "This is a thought.\n" + core.THINK_END + "\n")
+
+    def test_json_schema(self):
+        """Test a JSON schema is compiled to the grammar of the answer"""
+        schema = {"type": "object", "properties": {"drop": {"type": "array"}}}
+
+        with patch.object(core, 'json_schema_grammar', return_value='root ::= "{}"') as mock_grammar:
+            response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True, json_schema=schema)
+
+        mock_grammar.assert_called_once_with(schema)
+        self.assertEqual(response, MOCK_GRAMMAR_OUTPUT)
+
+    def test_reasoning_is_kept(self):
+        """Test the full response keeps the reasoning before the constrained answer"""
+        with patch.object(core, 'DISPLAY_EXTENDED_REASONING', True):
+            response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], choices=core.BINARY_CHOICES)
+
+        self.assertEqual(response, core.THINK_TRIGGER + "This is a thought.\n" + core.THINK_END + "\n" + MOCK_GRAMMAR_OUTPUT)
+
+
+class TestReasoningBudget(unittest.TestCase):
+    def setUp(self):
+        # Set up model instance for testing
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.stats.clear()
+
+    def test_budget_forces_answer(self):
+        """Test the reasoning is closed when the budget is reached"""
+        with patch.object(core, 'REASONING_BUDGETS', {core.CALL_TYPE_TOOL: 4}):
+            response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_TOOL)
+
+        self.assertEqual(response, core.THINK_TRIGGER + "This" + core.REASONING_BUDGET_TEXT + "\n" + core.THINK_END + "\n" + MOCK_MODEL_OUTPUT)
+        self.assertEqual(core.stats[f"{core.STAT_REASONING_BUDGET_REACHED} ({core.CALL_TYPE_TOOL})"], 1)
+
+    def test_budget_not_reached(self):
+        """Test reasoning shorter than the budget is kept unchanged"""
+        with patch.object(core, 'REASONING_BUDGETS', {core.CALL_TYPE_TOOL: 1024}):
+            response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True, call_type=core.CALL_TYPE_TOOL)
+
+        self.assertNotIn(core.STAT_REASONING_BUDGET_REACHED, core.get_stats_text())
+        self.assertEqual(core.model.prompts[-1][-len(core.THINK_END) - 1:], core.model.tokenize((core.THINK_END + "\n").encode('utf-8')))
+        self.assertTrue(response.endswith(BASIC_RESPONSE))
+
+    def test_skip_reasoning(self):
+        """Test a budget of 0 closes the reasoning block in the prompt"""
+        with patch.object(core, 'REASONING_BUDGETS', {core.CALL_TYPE_BINARY: 0}):
+            answer = core.binary_question(PRIME_DIRECTIVES, PROMPT, [])
+
+        self.assertTrue(answer)
+        self.assertEqual(len(core.model.prompts), 1)
+
+        prompt_text = ''.join(map(chr, core.model.prompts[0]))
+        self.assertTrue(prompt_text.endswith(core.THINK_TRIGGER + core.NO_THINK_TEXT))
+        self.assertEqual(core.stats[f"{core.STAT_REASONING_SKIPPED} ({core.CALL_TYPE_BINARY})"], 1)
+
+    def test_other_call_types_unlimited(self):
+        """Test call types without a budget reason in a single generation"""
+        with patch.object(core, 'REASONING_BUDGETS', {core.CALL_TYPE_TOOL: 0}):
+            core.send_prompt(PRIME_DIRECTIVES, PROMPT, [])
+
+        self.assertEqual(len(core.model.prompts), 1)
+        self.assertTrue(''.join(map(chr, core.model.prompts[0])).endswith(core.THINK_TRIGGER))
+
+
+class TestOneLineAnswer(unittest.TestCase):
+    def setUp(self):
+        # Set up model instance for testing
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.stats.clear()
+
+    def test_stops_after_first_line(self):
+        """Test one-line answers stop at the first line after the reasoning block"""
+        response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True, call_type=core.CALL_TYPE_WEB, one_line=True)
+
+        # The mock answer phase repeats the whole output, only its first line is kept
+        self.assertEqual(response, "This is a thought.")
+        self.assertEqual(core.stats[f"{core.STAT_ONE_LINE_STOPS} ({core.CALL_TYPE_WEB})"], 1)
+
+    def test_skipped_reasoning(self):
+        """Test one-line answers without reasoning are generated in a single call"""
+        with patch.object(core, 'REASONING_BUDGETS', {core.CALL_TYPE_CODEX: 0}):
+            response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True, call_type=core.CALL_TYPE_CODEX, one_line=True)
+
+        self.assertEqual(response, "This is a thought.")
+        self.assertEqual(len(core.model.prompts), 1)
+
+
+class TestModelRouting(unittest.TestCase):
+    def setUp(self):
+        # Main and control models with their own state
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        self.main_model = core.model
+        self.control_model = MockLlama(model_path="control.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.stats.clear()
+
+        self.patches = [
+            patch.object(core, 'MODEL_ROUTES', {core.CALL_TYPE_BINARY: core.MODEL_CONTROL}),
+            patch.object(core, 'model_slots', {
+                core.MODEL_MAIN: core.ModelSlot(self.main_model, "model.gguf", None),
+                core.MODEL_CONTROL: core.ModelSlot(self.control_model, "control.gguf", None)
+            })
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        core.activate_model(core.MODEL_MAIN)
+
+        for p in self.patches:
+            p.stop()
+
+    def test_call_types_are_routed(self):
+        """Test routed call types run on their model and the rest on the main model"""
+        core.binary_question(PRIME_DIRECTIVES, PROMPT, [])
+
+        # Reasoning and constrained answer
+        self.assertEqual(len(self.control_model.prompts), 2)
+        self.assertEqual(self.main_model.prompts, [])
+
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, [])
+
+        self.assertEqual(len(self.main_model.prompts), 1)
+        self.assertEqual(core.stats[f"{core.STAT_MODEL_CALLS} ({core.MODEL_CONTROL})"], 1)
+        self.assertEqual(core.stats[f"{core.STAT_MODEL_CALLS} ({core.MODEL_MAIN})"], 1)
+
+    def test_models_keep_their_caches(self):
+        """Test each model keeps its own turn tokens and prompt states"""
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, [])
+        main_turns = set(core.turn_token_cache)
+
+        core.binary_question(PRIME_DIRECTIVES, "Other question", [])
+        self.assertIs(core.model, self.control_model)
+        self.assertIn(core.format_user_turn("Other question"), core.turn_token_cache)
+
+        core.activate_model(core.MODEL_MAIN)
+        self.assertIs(core.model, self.main_model)
+        self.assertEqual(set(core.turn_token_cache), main_turns)
+
+    def test_unloaded_route_uses_main_model(self):
+        """Test call types routed to a model that is not loaded run on the main model"""
+        with patch.object(core, 'MODEL_ROUTES', {core.CALL_TYPE_BINARY: core.MODEL_SUMMARY}):
+            core.binary_question(PRIME_DIRECTIVES, PROMPT, [])
+
+        self.assertEqual(len(self.main_model.prompts), 2)
+        self.assertEqual(self.control_model.prompts, [])
+
+
+def write_gguf(path, metadata):
+    # Minimal GGUF file with metadata only (strings, u32 values and string arrays)
+    def gguf_string(text):
+        data = text.encode('utf-8')
+        return struct.pack("<Q", len(data)) + data
+
+    data = b"GGUF" + struct.pack("<IQQ", 3, 0, len(metadata))
+
+    for key, value in metadata.items():
+        data += gguf_string(key)
+
+        if isinstance(value, str):
+            data += struct.pack("<I", 8) + gguf_string(value)
+        elif isinstance(value, list):
+            data += struct.pack("<IIQ", 9, 8, len(value)) + b"".join(gguf_string(item) for item in value)
+        else:
+            data += struct.pack("<II", 4, value)
+
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+class TestMemoryPlanner(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.model_path = os.path.join(self.temp_dir, "model.gguf")
+
+        # 2 layers x 2 KV heads x (16 + 16) values per token
+        write_gguf(self.model_path, {
+            "general.architecture": "qwen3",
+            "tokenizer.ggml.tokens": ["a", "b"],
+            "qwen3.block_count": 2,
+            "qwen3.attention.head_count": 4,
+            "qwen3.attention.head_count_kv": 2,
+            "qwen3.embedding_length": 64
+        })
+
+        self.patches = [
+            patch.object(core, 'CONTEXT_SIZE', core.MIN_CONTEXT_SIZE),
+            patch.object(core, 'CONFIGURED_CONTEXT_SIZE', core.MIN_CONTEXT_SIZE),
+            patch.object(core, 'MAX_INPUT_TOKENS', core.MIN_CONTEXT_SIZE - core.MAX_RESPONSE_SIZE),
+            patch.object(core, 'KV_CACHE_TYPE', core.KV_CACHE_TYPE_AUTO),
+            patch.object(core, 'CONFIGURED_KV_CACHE_TYPE', core.KV_CACHE_TYPE_AUTO),
+            patch.object(core, 'DRAFT_MODEL', "")
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+        shutil.rmtree(self.temp_dir)
+
+    def test_read_metadata(self):
+        """Test GGUF metadata is read and string arrays are skipped"""
+        metadata = core.read_gguf_metadata(self.model_path)
+
+        self.assertEqual(metadata["general.architecture"], "qwen3")
+        self.assertEqual(metadata["qwen3.block_count"], 2)
+        self.assertIsNone(metadata["tokenizer.ggml.tokens"])
+
+    def test_kv_cache_size(self):
+        """Test the KV cache size depends on the context size and KV cache type"""
+        metadata = core.read_gguf_metadata(self.model_path)
+
+        self.assertEqual(core.get_kv_cache_size(metadata, 1024, "f16"), 1024 * 128 * 2)
+        self.assertEqual(core.get_kv_cache_size(metadata, 1024, "q8_0"), 1024 * 128 * 34 // 32)
+
+    def test_plan_fits_memory(self):
+        """Test the most precise KV cache type that fits is picked"""
+        with patch.object(core, 'MODEL_MEMORY', 20 * 1024 ** 2):
+            weights, kv_cache_size = core.plan_memory(self.model_path)
+
+        self.assertEqual(core.KV_CACHE_TYPE, "q8_0")
+        self.assertEqual(core.CONTEXT_SIZE, core.MIN_CONTEXT_SIZE)
+        self.assertEqual(weights, os.path.getsize(self.model_path))
+        self.assertEqual(kv_cache_size, core.MIN_CONTEXT_SIZE * 128 * 34 // 32)
+
+    def test_plan_keeps_largest_context(self):
+        """Test a larger context with a smaller KV cache type is preferred"""
+        with patch.object(core, 'CONFIGURED_CONTEXT_SIZE', core.MIN_CONTEXT_SIZE * 2), patch.object(core, 'MODEL_MEMORY', 20 * 1024 ** 2):
+            core.plan_memory(self.model_path)
+            context_size = core.CONTEXT_SIZE
+
+        self.assertEqual(core.KV_CACHE_TYPE, "q4_0")
+        self.assertEqual(context_size, core.MIN_CONTEXT_SIZE * 2)
+
+    def test_replan_uses_configured_values(self):
+        """Test a later plan starts again from the configured context size and KV cache type"""
+        with patch.object(core, 'CONFIGURED_CONTEXT_SIZE', core.MIN_CONTEXT_SIZE * 2):
+            with patch.object(core, 'MODEL_MEMORY', 12 * 1024 ** 2):
+                core.plan_memory(self.model_path)
+
+            self.assertEqual((core.CONTEXT_SIZE, core.KV_CACHE_TYPE), (core.MIN_CONTEXT_SIZE, "q4_0"))
+
+            # More memory is free at the next load
+            with patch.object(core, 'MODEL_MEMORY', 0):
+                core.plan_memory(self.model_path)
+
+        self.assertEqual((core.CONTEXT_SIZE, core.KV_CACHE_TYPE), (core.MIN_CONTEXT_SIZE * 2, "f16"))
+
+    def test_quantized_cache_needs_flash_attention(self):
+        """Test quantized KV cache types enable flash attention"""
+        with patch.object(core, 'KV_CACHE_TYPE', "q8_0"), patch.object(core, 'FLASH_ATTENTION', False):
+            params = core.get_model_params()
+
+        self.assertTrue(params["flash_attn"])
+        self.assertEqual(params["type_k"], 8)
+
+
+class TestModelResidency(unittest.TestCase):
+    def setUp(self):
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.stats.clear()
+
+        self.gb = 1024 ** 3
+        self.patches = [
+            patch.object(core, 'kv_cache_memory', 4 * self.gb),
+            patch.object(core, 'load_seconds', 20.0),
+            patch.object(core, 'GPU_LAYERS', -1),
+            patch.object(core, 'OFFLOAD_KQV', True),
+            patch.object(core, 'can_close_kv_caches', return_value=True)
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_plan_residency(self):
+        """Test the models stay loaded when both fit, then only the KV cache is freed, then they are unloaded"""
+        with patch.object(core, 'get_free_ram', return_value=32 * self.gb):
+            self.assertEqual(core.plan_residency(8 * self.gb, 10 * self.gb, 16 * self.gb), core.RESIDENCY_KEEP)
+            self.assertEqual(core.plan_residency(8 * self.gb, 10 * self.gb, 8 * self.gb), core.RESIDENCY_KV_CACHE)
+            self.assertEqual(core.plan_residency(8 * self.gb, 10 * self.gb, 2 * self.gb), core.RESIDENCY_UNLOAD)
+
+            # A KV cache in RAM does not free VRAM
+            with patch.object(core, 'OFFLOAD_KQV', False):
+                self.assertEqual(core.plan_residency(8 * self.gb, 10 * self.gb, 8 * self.gb), core.RESIDENCY_UNLOAD)
+
+        # Without GPU the pipeline only needs RAM
+        with patch.object(core, 'get_free_ram', return_value=18 * self.gb), patch.object(core, 'GPU_LAYERS', 0):
+            self.assertEqual(core.plan_residency(20 * self.gb, 0, 0), core.RESIDENCY_KV_CACHE)
+
+    def test_unknown_kv_cache_unloads(self):
+        """Test models without a projected KV cache size are unloaded when they do not fit"""
+        with patch.object(core, 'kv_cache_memory', 0), patch.object(core, 'get_free_ram', return_value=32 * self.gb):
+            self.assertEqual(core.plan_residency(8 * self.gb, 10 * self.gb, 8 * self.gb), core.RESIDENCY_UNLOAD)
+
+    def test_kept_models_save_reload(self):
+        """Test keeping the models skips the reload and records the time saved"""
+        with patch.object(core, 'get_free_ram', return_value=32 * self.gb), patch.object(core, 'unload_model') as mock_unload, patch.object(core, 'load_model') as mock_load:
+            residency = core.release_model_memory(8 * self.gb, 10 * self.gb, 16 * self.gb)
+            core.restore_model_memory(residency)
+
+        mock_unload.assert_not_called()
+        mock_load.assert_not_called()
+        self.assertEqual(core.model.prompts, [])
+        self.assertAlmostEqual(core.stats[core.STAT_RELOAD_TIME_SAVED], 20000, delta=100)
+
+    def test_kv_cache_is_reopened(self):
+        """Test only the KV caches are closed and opened again"""
+        with patch.object(core, 'get_free_ram', return_value=32 * self.gb), patch.object(core, 'close_kv_caches') as mock_close, patch.object(core, 'open_kv_caches') as mock_open, patch.object(core, 'load_model') as mock_load:
+            residency = core.release_model_memory(8 * self.gb, 10 * self.gb, 8 * self.gb)
+            core.restore_model_memory(residency)
+
+        self.assertEqual(residency, core.RESIDENCY_KV_CACHE)
+        mock_close.assert_called_once()
+        mock_open.assert_called_once()
+        mock_load.assert_not_called()
+        self.assertIn(core.STAT_RELOAD_TIME_SAVED, core.stats)
+
+    def test_unknown_internals_unload(self):
+        """Test models are unloaded when the llama_cpp internals to free the KV cache alone are missing"""
+        with patch.object(core, 'get_free_ram', return_value=32 * self.gb), patch.object(core, 'can_close_kv_caches', return_value=False):
+            self.assertEqual(core.plan_residency(8 * self.gb, 10 * self.gb, 8 * self.gb), core.RESIDENCY_UNLOAD)
+
+        # The mocked llama_cpp has none of them
+        self.patches[-1].stop()
+
+        try:
+            self.assertFalse(core.can_close_kv_caches())
+        finally:
+            self.patches[-1].start()
+
+    def test_failed_reopen_reloads(self):
+        """Test the models are loaded again when their KV cache cannot be reopened"""
+        # The model lock is held from the release of the model memory
+        core.model_lock.acquire()
+
+        with patch.object(core, 'open_kv_caches', side_effect=AttributeError("_ctx")), patch.object(core, 'unload_model') as mock_unload, patch.object(core, 'load_model') as mock_load:
+            core.restore_model_memory(core.RESIDENCY_KV_CACHE)
+
+        mock_unload.assert_called_once()
+        mock_load.assert_called_once_with(startup=False)
+        self.assertNotIn(core.STAT_RELOAD_TIME_SAVED, core.stats)
+
+    def test_kv_cache_release_is_opt_in(self):
+        """Test the KV cache is only freed alone with the option and the checked llama_cpp version"""
+        mock_internals = types.ModuleType('llama_cpp._internals')
+        setattr(mock_internals, 'LlamaContext', object)
+        self.patches[-1].stop()
+
+        try:
+            with patch.dict(sys.modules, {'llama_cpp._internals': mock_internals}), patch.object(core, 'model_slots', {}):
+                self.assertFalse(core.can_close_kv_caches())
+
+                with patch.object(core, 'KV_CACHE_RELEASE', True):
+                    self.assertFalse(core.can_close_kv_caches())
+
+                    with patch.object(mock_llama_cpp, '__version__', core.KV_CACHE_LLAMA_CPP_VERSION, create=True):
+                        self.assertTrue(core.can_close_kv_caches())
+        finally:
+            self.patches[-1].start()
+
+    def test_unloaded_models_are_reloaded(self):
+        """Test models that do not fit are unloaded and loaded again, other threads wait for them meanwhile"""
+        def try_model_lock():
+            acquired.append(core.model_lock.acquire(blocking=False))
+
+        acquired = []
+
+        with patch.object(core, 'get_free_ram', return_value=4 * self.gb), patch.object(core, 'unload_model') as mock_unload, patch.object(core, 'load_model') as mock_load:
+            residency = core.release_model_memory(8 * self.gb, 10 * self.gb, 8 * self.gb)
+
+            other_thread = threading.Thread(target=try_model_lock)
+            other_thread.start()
+            other_thread.join()
+
+            core.restore_model_memory(residency)
+
+        self.assertEqual(acquired, [False])
+
+        self.assertEqual(residency, core.RESIDENCY_UNLOAD)
+        mock_unload.assert_called_once()
+        mock_load.assert_called_once_with(startup=False)
+        self.assertNotIn(core.STAT_RELOAD_TIME_SAVED, core.stats)
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.original_stages = startup.stages
+        startup.stages = []
+
+    def tearDown(self):
+        startup.stages = self.original_stages
+
+    def test_stages_run_after_dependencies(self):
+        """Test stages run concurrently and wait for the stages they depend on"""
+        order = []
+        release = threading.Event()
+
+        model = startup.add_stage("model", lambda: (release.wait(5), order.append("model")))
+        startup.add_stage("warm-up", lambda: order.append("warm-up"), [model])
+        startup.add_stage("venv", lambda: order.append("venv"))
+
+        startup.stages[-1].done.wait(5)
+        self.assertEqual(order, ["venv"])
+
+        release.set()
+        self.assertEqual(startup.wait_ready(), [])
+        self.assertEqual(order, ["venv", "model", "warm-up"])
+
+    def test_failed_stage_is_reported(self):
+        """Test failed stages are returned by the readiness barrier"""
+        def fail():
+            raise OSError("pip failed")
+
+        startup.add_stage("venv", fail)
+        startup.run_stage("modules", lambda: None)
+
+        failed = startup.wait_ready()
+
+        self.assertEqual([stage.name for stage in failed], ["venv"])
+        self.assertIsInstance(failed[0].error, OSError)
+
+    def test_exit_is_raised(self):
+        """Test an exit in a background stage stops the startup at the barrier"""
+        startup.add_stage("model", lambda: sys.exit(1))
+
+        with self.assertRaises(SystemExit):
+            startup.wait_ready()
+
+    def test_timing_text(self):
+        """Test the timing table lists every stage and the ready time"""
+        startup.run_stage("config", lambda: None)
+        startup.add_stage("model", lambda: None)
+        startup.wait_ready()
+
+        text = startup.get_timing_text()
+
+        self.assertIn("config", text)
+        self.assertIn("model", text)
+        self.assertIn(startup.STARTUP_READY_TEXT, text)
+
+
+class TestPlugins(unittest.TestCase):
+    def import_plugin(self, config):
+        # The plugin module initializes the enabled plugins when it is imported
+        mock_comms = types.ModuleType('comms')
+        setattr(mock_comms, 'printSystemText', core.print_system_text)
+        mock_toolchain = types.ModuleType('toolchain')
+        setattr(mock_toolchain, 'add_tool', lambda name, description, action: None)
+
+        with patch.dict(sys.modules, {'comms': mock_comms, 'toolchain': mock_toolchain}), patch.dict(core.config, config, clear=True), patch('os.makedirs'):
+            sys.modules.pop('plugin', None)
+            import plugin
+
+        return plugin
+
+    def test_disabled_plugin_is_not_imported(self):
+        """Test the modules of the plugins are not imported at startup, enabled or not"""
+        plugin = self.import_plugin({"ENABLE_WEB_PLUGIN": "NO", "ENABLE_IMAGE_GENERATION_PLUGIN": "YES"})
+
+        self.assertEqual(plugin.plugin_modules, [plugin.IMAGE_GENERATION_PLUGIN_MODULE])
+        self.assertNotIn(plugin.WEB_PLUGIN_MODULE, sys.modules)
+        self.assertNotIn(plugin.IMAGE_GENERATION_PLUGIN_MODULE, sys.modules)
+
+    def test_plugin_is_imported_on_first_use(self):
+        """Test the module of a plugin is imported when its tool is first used"""
+        plugin = self.import_plugin({"ENABLE_WEB_PLUGIN": "YES"})
+
+        with patch.object(plugin.importlib, 'import_module') as mock_import, patch.object(core, 'send_prompt', return_value="query"):
+            mock_import.return_value.search.return_value = []
+            result = plugin.web_search(PRIME_DIRECTIVES, "Search the news", [])
+
+        mock_import.assert_called_with(plugin.WEB_PLUGIN_MODULE)
+        self.assertTrue(result.endswith(plugin.WEB_SEARCH_FAILED_TEXT))
+
+
+class TestProfile(unittest.TestCase):
+    def test_profile_lists_top_level_imports(self):
+        """Test the startup profile parses the import times into a table of the top-level imports"""
+        import subprocess
+        import magi
+
+        stderr = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 | _io",
+            "import time:      1000 |       4000 |   llama_cpp",
+            "import time:       200 |       5000 | core",
+            "import time:       300 |       2000 | startup",
+        ])
+
+        with patch('subprocess.run', return_value=subprocess.CompletedProcess([], 0, stderr=stderr)), patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(magi.profile_startup(), 0)
+
+        lines = stdout.getvalue().split(magi.STARTUP_IMPORTS_TEXT)[-1].split()
+
+        # Slowest first, the nested imports are part of the top-level ones
+        self.assertEqual(lines, ["5.0", "core", "2.0", "startup", "0.1", "_io", "7.1", "total"])
+
+
+class TestTuning(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.patches = [
+            patch.object(core, 'TUNING_FILE_PATH', os.path.join(self.temp_dir, "tuning.json")),
+            patch.object(core, 'tuning_params', {}),
+            patch.object(core, 'find_model_file', return_value="model.gguf"),
+            patch.object(core, 'model', None),
+            patch.object(core, 'unload_model'),
+            patch.object(core, 'load_model'),
+            patch.object(core, 'print_system_text'),
+            patch.object(core, 'get_cpu_count', return_value=8)
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def fake_benchmark(model_path, params):
+        # Generation is fastest with 6 threads, prompt evaluation with 8 threads and large batches
+        prompt_speed = params["n_threads_batch"] * params.get("n_batch", 512) / 10
+        generation_speed = 10 - abs(params["n_threads"] - 6)
+        return prompt_speed, generation_speed
+
+    def test_fastest_settings_are_saved(self):
+        """Test the tuner saves the fastest settings and the model loads them"""
+        with patch.object(core, 'benchmark_model', side_effect=self.fake_benchmark) as mock_benchmark:
+            core.tune_model()
+
+        # Settings already measured are not benchmarked again
+        measured = [core.format_tuning_params(call.args[1]) for call in mock_benchmark.call_args_list]
+        self.assertEqual(len(measured), len(set(measured)))
+
+        core.load_tuning("model.gguf")
+
+        self.assertEqual(core.tuning_params["n_threads"], 6)
+        self.assertEqual(core.tuning_params["n_threads_batch"], 8)
+        self.assertEqual(core.tuning_params["n_batch"], 2048)
+        self.assertEqual(core.get_model_params()["n_threads"], 6)
+
+    def test_other_model_is_not_tuned(self):
+        """Test a tuning file measured with another model is ignored"""
+        with patch.object(core, 'benchmark_model', side_effect=self.fake_benchmark):
+            core.tune_model()
+
+        core.load_tuning("other.gguf")
+
+        self.assertEqual(core.tuning_params, {})
+        self.assertNotIn("n_threads", core.get_model_params())
+
+    def test_loaded_model_is_reloaded(self):
+        """Test the models unloaded for the benchmark are loaded again with the new settings"""
+        with patch.object(core, 'benchmark_model', side_effect=self.fake_benchmark):
+            core.tune_model()
+
+        core.load_model.assert_not_called()
+
+        with patch.object(core, 'benchmark_model', side_effect=self.fake_benchmark), patch.object(core, 'model', MockLlama(model_path="model.gguf")):
+            core.tune_model()
+
+        core.load_model.assert_called_once_with(startup=False)
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.patches = [
+            patch.object(core, 'REASONING_BUDGETS', {}),
+            patch.object(core, 'print_system_text')
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_reasoning_budgets(self):
+        """Test the reasoning budgets are read per call type"""
+        with patch.object(core, 'config', {core.REASONING_BUDGETS_KEY: "Tool: 64, binary:0"}):
+            core.configure_reasoning_budgets()
+
+        self.assertEqual(core.REASONING_BUDGETS, {core.CALL_TYPE_TOOL: 64, core.CALL_TYPE_BINARY: 0})
+
+    def test_invalid_reasoning_budget_exits(self):
+        """Test a negative or unreadable reasoning budget is reported as a config error"""
+        for budgets in ("tool: -1", "tool: many"):
+            with patch.object(core, 'config', {core.REASONING_BUDGETS_KEY: budgets}), self.assertRaises(SystemExit):
+                core.configure_reasoning_budgets()
+
+            core.print_system_text.assert_called_with(core.CONFIG_ERROR + core.REASONING_BUDGETS_INVALID_TEXT)
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.clear_prompt_cache()
+        core.stats.clear()
+
+        self.patches = [
+            patch.object(core, 'PROMPT_CACHE_SIZE', 1024 ** 3),
+            patch.object(core, 'MODEL_WARMUP', True),
+            patch.object(core, 'MODEL_PRELOAD', core.MODEL_PRELOAD_READAHEAD),
+            patch.object(core, 'model_slots', {core.MODEL_MAIN: core.ModelSlot(core.model, "model.gguf", None)}),
+            patch.object(core, 'preload_model_file')
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+        core.clear_prompt_cache()
+
+    def test_prime_directives_are_evaluated(self):
+        """Test the warm-up evaluates the Prime Directives and the first prompt reuses them"""
+        core.start_warmup(PRIME_DIRECTIVES)
+        core.warmup_thread.join()
+
+        core.preload_model_file.assert_called_once_with("model.gguf")
+        self.assertEqual(len(core.prompt_cache), 1)
+        self.assertIn(core.STAT_TIME_TO_READY, core.stats)
+
+        warm_tokens = len(next(iter(core.prompt_cache)))
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, [])
+
+        self.assertEqual(core.stats[core.STAT_PROMPT_CACHE_HIT], warm_tokens)
+
+    def test_warmup_disabled(self):
+        """Test no background work runs when preloading and warm-up are disabled"""
+        with patch.object(core, 'MODEL_WARMUP', False), patch.object(core, 'MODEL_PRELOAD', core.MODEL_PRELOAD_NONE):
+            core.start_warmup(PRIME_DIRECTIVES)
+
+        self.assertIsNone(core.warmup_thread)
+        self.assertEqual(core.prompt_cache, {})
+
+    def test_mlock_preload(self):
+        """Test the MLOCK preload mode locks the model weights"""
+        with patch.object(core, 'MODEL_PRELOAD', core.MODEL_PRELOAD_MLOCK):
+            self.assertTrue(core.get_model_params()["use_mlock"])
+
+
+class TestModelServer(unittest.TestCase):
+    def setUp(self):
+        # Model server with a mock model, served from a background thread
+        self.temp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.temp_dir, "server.sock")
+        self.server_model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        self.server = model_server.ModelServer(self.socket_path, {core.MODEL_MAIN: self.server_model}, {core.MODEL_MAIN: "model.gguf"})
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+        core.model = core.RemoteModel(self.socket_path, core.MODEL_MAIN)
+        core.stats.clear()
+
+    def tearDown(self):
+        core.model.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_remote_completion(self):
+        """Test prompts are tokenized and completed by the model server"""
+        response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True)
+
+        self.assertEqual(response, BASIC_RESPONSE)
+        self.assertEqual(core.model.model_file, "model.gguf")
+        self.assertEqual(len(self.server_model.prompts), 1)
+        self.assertEqual(core.model.input_ids, self.server_model.input_ids)
+
+    def test_remote_generation_runs_outside_the_lock(self):
+        """Test a remote generation uses the session it started with while other threads take the model lock"""
+        remote = core.model
+        generate = remote.__call__
+        swapped = []
+
+        def swap_model(*args, **kwargs):
+            # Another thread selects a model while this one generates
+            def select():
+                with core.model_lock:
+                    core.model = MockLlama(model_path="other.gguf", n_ctx=core.CONTEXT_SIZE)
+                    swapped.append(True)
+
+            thread = threading.Thread(target=select)
+            thread.start()
+            thread.join(5)
+
+            return generate(*args, **kwargs)
+
+        try:
+            with patch.object(core.RemoteModel, '__call__', side_effect=swap_model):
+                response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True)
+        finally:
+            core.model = remote
+
+        self.assertEqual(swapped, [True])
+        self.assertEqual(response, BASIC_RESPONSE)
+        self.assertEqual(len(self.server_model.prompts), 1)
+
+    def test_requests_during_a_stream_are_kept(self):
+        """Test request lines sent while a stream runs are answered after it, not taken for cancels"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(5)
+            connection.connect(self.socket_path)
+            responses = connection.makefile('rb')
+
+            requests = [
+                {"op": "complete", "tokens": [1, 2], "stream": True, "kwargs": {"max_tokens": 5}},
+                {"op": "tokenize", "text": "ab", "add_bos": False, "special": False}
+            ]
+            connection.sendall(b"".join(json.dumps(request).encode('utf-8') + b"\n" for request in requests))
+
+            lines = []
+
+            while "tokens" not in (line := json.loads(responses.readline())):
+                lines.append(line)
+
+        self.assertIn("done", lines[-1])
+        self.assertEqual(line["tokens"], [ord("a"), ord("b")])
+
+    def test_remote_grammar(self):
+        """Test grammars are sent as text and compiled by the model server"""
+        self.assertTrue(core.binary_question(PRIME_DIRECTIVES, PROMPT, []))
+
+    def test_remote_stream_is_cancelled(self):
+        """Test closing a stream early stops the server generation and keeps the session usable"""
+        response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True, call_type=core.CALL_TYPE_WEB, one_line=True)
+        self.assertEqual(response, "This is a thought.")
+
+        response = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True)
+        self.assertEqual(response, BASIC_RESPONSE)
+
+    def test_sessions_keep_their_state(self):
+        """Test each connection keeps its own model state on the shared model"""
+        other = core.RemoteModel(self.socket_path, core.MODEL_MAIN)
+
+        try:
+            core.model.eval([1, 2, 3])
+            other.eval([4, 5])
+            core.model.eval([6])
+
+            self.assertEqual(core.model.input_ids, [1, 2, 3, 6])
+            self.assertEqual(other.input_ids, [4, 5])
+        finally:
+            other.close()
+
+    def test_remote_generation_is_cancelled(self):
+        """Test a cancelled job stops the server stream and leaves the session usable"""
+        core.stream_listener = lambda text: core.cancel_event.set()
+
+        try:
+            with self.assertRaises(core.JobCancelled):
+                core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], stream=True)
+        finally:
+            core.stream_listener = None
+            core.cancel_event.clear()
+
+        self.assertEqual(core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True), BASIC_RESPONSE)
+
+    def test_summaries_run_in_parallel_sessions(self):
+        """Test the block summaries of a model server run in several sessions while the blocks are chunked"""
+        taken = []
+
+        def blocks():
+            for block in ["first block", "second block", "third block"]:
+                taken.append(block)
+                yield block
+
+        with patch.object(core, 'MODEL_SERVER', self.socket_path), patch.object(core, 'MODEL_SERVER_SESSIONS', 2), patch.object(core, 'SUMMARY_FAN_IN', 4):
+            summary = core.tree_summary_blocks(PROMPT, blocks())
+
+        self.assertEqual(summary, BASIC_RESPONSE)
+        self.assertEqual(len(taken), 3)
+        self.assertEqual(len(self.server_model.prompts), 4)
+        self.assertGreater(len(core.model.streams), 1)
+
+    def test_summaries_in_a_model_call_run_in_turn(self):
+        """Test summaries of a model call (compaction) do not wait for the summary pool"""
+        core.model_call.active = True
+
+        try:
+            with patch.object(core, 'MODEL_SERVER', self.socket_path), patch.object(core, 'MODEL_SERVER_SESSIONS', 2):
+                threads = core.map_summaries(lambda item: threading.current_thread().name, [1, 2])
+        finally:
+            core.model_call.active = False
+
+        self.assertEqual(threads, [threading.current_thread().name] * 2)
+
+    def test_unknown_role(self):
+        """Test connecting to a role the server has not loaded fails"""
+        with self.assertRaises(RuntimeError):
+            core.RemoteModel(self.socket_path, core.MODEL_CONTROL)
+
+
+class MockBatchEngine:
+    # Batched context of the mock model, one sampler per completion that spells the mock output
+    batch_size = 8
+
+    def __init__(self, llama=None, sequences=1):
+        self.batches = []
+
+    def decode(self, entries):
+        self.batches.append([(seq_id, len(tokens)) for seq_id, tokens, position in entries])
+        indices = []
+        n = 0
+
+        for seq_id, tokens, position in entries:
+            n += len(tokens)
+            indices.append(n - 1)
+
+        return indices
+
+    def clear(self, seq_id, position):
+        pass
+
+    def new_sampler(self, kwargs):
+        output = MOCK_GRAMMAR_OUTPUT if kwargs.get('grammar') else MOCK_MODEL_OUTPUT
+
+        return iter([ord(c) for c in output] + [0])
+
+    def sample(self, sampler, index):
+        return next(sampler)
+
+    def is_end(self, token):
+        return token == 0
+
+    def token_bytes(self, token):
+        return chr(token).encode('utf-8')
+
+
+class TestBatchScheduler(unittest.TestCase):
+    def setUp(self):
+        self.engine = MockBatchEngine()
+
+    def run_completions(self, sequences, prompts, max_tokens=100):
+        scheduler = model_server.BatchScheduler(self.engine, sequences)
+
+        try:
+            # Submitted together, before the scheduler takes any of them
+            with scheduler.condition:
+                completions = [scheduler.submit(object(), prompt, max_tokens, {}) for prompt in prompts]
+
+            return ["".join(chunk['choices'][0]['text'] for chunk in scheduler.stream(completion)) for completion in completions]
+        finally:
+            scheduler.close()
+
+    def test_sessions_share_forward_passes(self):
+        """Test generating sessions are decoded in the same batch"""
+        responses = self.run_completions(2, [[1, 2], [3, 4]])
+
+        self.assertEqual(responses, [MOCK_MODEL_OUTPUT, MOCK_MODEL_OUTPUT])
+        self.assertEqual(len(self.engine.batches), len(MOCK_MODEL_OUTPUT) + 1)
+        self.assertTrue(all({seq_id for seq_id, size in batch} == {0, 1} for batch in self.engine.batches))
+
+    def test_concurrency_limit(self):
+        """Test sessions beyond the limit wait for a free sequence"""
+        responses = self.run_completions(1, [[1, 2], [3, 4]])
+
+        self.assertEqual(responses, [MOCK_MODEL_OUTPUT, MOCK_MODEL_OUTPUT])
+        self.assertTrue(all(len(batch) == 1 for batch in self.engine.batches))
+
+    def test_prompts_share_the_batch(self):
+        """Test a long prompt does not delay the prompts of other sessions"""
+        self.run_completions(2, [list(range(1, 41)), [1, 2, 3]], max_tokens=1)
+
+        self.assertEqual(sorted(self.engine.batches[0]), [(0, 5), (1, 3)])
+
+    def test_stop_strings_and_token_limit(self):
+        """Test completions finish at stop strings and at the token limit"""
+        scheduler = model_server.BatchScheduler(self.engine, 2)
+
+        try:
+            chunks = list(scheduler.stream(scheduler.submit(object(), [1], 100, {"stop": ["</think>"]})))
+            self.assertEqual("".join(chunk['choices'][0]['text'] for chunk in chunks), "This is a thought.\n")
+            self.assertEqual(chunks[-1]['choices'][0]['finish_reason'], "stop")
+
+            chunks = list(scheduler.stream(scheduler.submit(object(), [1], 4, {})))
+            self.assertEqual("".join(chunk['choices'][0]['text'] for chunk in chunks), "This")
+            self.assertEqual(chunks[-1]['choices'][0]['finish_reason'], "length")
+        finally:
+            scheduler.close()
+
+    def test_session_prefix_is_reused(self):
+        """Test a session only evaluates the tokens after its cached prefix"""
+        scheduler = model_server.BatchScheduler(self.engine, 2)
+        session = object()
+
+        try:
+            list(scheduler.stream(scheduler.submit(session, [1, 2, 3, 4], 0, {})))
+            self.assertEqual(scheduler.input_ids(session), [1, 2, 3, 4])
+
+            self.engine.batches.clear()
+            list(scheduler.stream(scheduler.submit(session, [1, 2, 3, 4, 5, 6], 0, {})))
+            self.assertEqual(self.engine.batches, [[(0, 2)]])
+        finally:
+            scheduler.close()
+
+    def test_cancel_during_prefill(self):
+        """Test a cancelled completion stops before the rest of its prompt is evaluated"""
+        scheduler = model_server.BatchScheduler(self.engine, 1)
+
+        try:
+            with scheduler.condition:
+                completion = scheduler.submit(object(), list(range(1, 41)), 100, {})
+                scheduler.cancel(completion)
+
+            chunks = list(scheduler.stream(completion))
+
+            self.assertEqual("".join(chunk['choices'][0]['text'] for chunk in chunks), "")
+            self.assertEqual(self.engine.batches, [])
+        finally:
+            scheduler.close()
+
+    def test_batched_model_server(self):
+        """Test remote prompts are completed by the scheduler of a model server"""
+        temp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(temp_dir, "server.sock")
+
+        with patch('model_server.LlamaBatchEngine', MockBatchEngine):
+            server = model_server.ModelServer(socket_path, {core.MODEL_MAIN: MockLlama()}, {core.MODEL_MAIN: "model.gguf"}, sessions=2)
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        core.model = core.RemoteModel(socket_path, core.MODEL_MAIN)
+
+        try:
+            self.assertEqual(core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True), BASIC_RESPONSE)
+            self.assertTrue(core.binary_question(PRIME_DIRECTIVES, PROMPT, []))
+
+            core.model.reset()
+            core.model.eval([1, 2, 3])
+            self.assertEqual(core.model.input_ids, [1, 2, 3])
+        finally:
+            core.model.close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_unsupported_llama_cpp_runs_sessions_in_turn(self):
+        """Test a model server falls back to one session at a time when the llama_cpp internals do not match"""
+        temp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(temp_dir, "server.sock")
+        server = model_server.ModelServer(socket_path, {core.MODEL_MAIN: MockLlama()}, {core.MODEL_MAIN: "model.gguf"}, sessions=2)
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        core.model = core.RemoteModel(socket_path, core.MODEL_MAIN)
+
+        try:
+            self.assertEqual(server.schedulers, {})
+            self.assertEqual(core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], hide_reasoning=True), BASIC_RESPONSE)
+        finally:
+            core.model.close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_batch_support_check(self):
+        """Test samplers with the older penalty parameters are not used for batching"""
+        class Sampler:
+            def add_penalties(self, n_vocab, special_eos_id, linefeed_id, penalty_last_n, penalty_repeat, penalty_freq, penalty_present, penalize_nl, ignore_eos):
+                pass
+
+        internals = types.SimpleNamespace(LlamaContext=object, LlamaBatch=object, LlamaSampler=Sampler)
+
+        with self.assertRaises(RuntimeError) as error:
+            model_server.check_batch_support(types.SimpleNamespace(__version__="0.3.1"), internals, MockLlama())
+
+        self.assertIn("0.3.1", str(error.exception))
+        self.assertIn("add_penalties", str(error.exception))
+
+
+class CancellingLlama(MockLlama):
+    # User input arrives while the response is generated
+    def __call__(self, prompt, max_tokens=100, temperature=1.0, **kwargs):
+        core.cancel_event.set()
+        self.stopped = kwargs['stopping_criteria'][0](prompt, None)
+
+        return super().__call__(prompt, max_tokens, temperature, **kwargs)
+
+
+class TestCancellation(unittest.TestCase):
+    def setUp(self):
+        core.model = CancellingLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.clear_prompt_cache()
+
+    def tearDown(self):
+        core.cancel_event.clear()
+
+    def test_generation_is_cancelled(self):
+        """Test the stopping criteria stops a cancelled generation and the prompt is removed from the context"""
+        context = []
+
+        with self.assertRaises(core.JobCancelled):
+            core.send_prompt(PRIME_DIRECTIVES, PROMPT, context)
+
+        self.assertTrue(core.model.stopped)
+        self.assertEqual(context, [core.SYSTEM_TEXT + PRIME_DIRECTIVES + core.EOS])
+
+    def test_cancelled_job_sends_no_prompts(self):
+        """Test prompts of a cancelled job are not sent to the model"""
+        core.cancel_event.set()
+
+        with self.assertRaises(core.JobCancelled):
+            core.binary_question(PRIME_DIRECTIVES, BINARY_QUESTION, [])
+
+        self.assertEqual(core.model.prompts, [])
+
+    def test_cancellation_passes_error_handlers(self):
+        """Test tool error handlers do not catch the cancellation"""
+        core.cancel_event.set()
+
+        with self.assertRaises(core.JobCancelled):
+            try:
+                core.check_cancelled()
+            except Exception:
+                pass
+
+
+class TestHttpApi(unittest.TestCase):
+    def setUp(self):
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.clear_prompt_cache()
+
+        # Any free localhost port
+        self.server = api.ApiServer(0, PRIME_DIRECTIVES, 1, 2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, path, body, headers=None):
+        connection = http.client.HTTPConnection(api.API_HOST, self.server.server_address[1], timeout=10)
+        connection.request("POST", path, json.dumps(body), {"Content-Type": "application/json", **(headers or {})})
+
+        return connection.getresponse()
+
+    def test_completion(self):
+        """Test plain completions return an OpenAI response with timing headers"""
+        with self.post(api.COMPLETIONS_PATH, {"prompt": PROMPT}) as response:
+            data = json.loads(response.read())
+
+            self.assertEqual(response.status, 200)
+            self.assertEqual(data["choices"][0]["text"], BASIC_RESPONSE)
+            self.assertIn(api.QUEUE_TIME_HEADER, response.headers)
+            self.assertIn(api.PROCESSING_TIME_HEADER, response.headers)
+
+    def test_streamed_chat_session(self):
+        """Test chat completions are streamed as server-sent events and keep the context of their session"""
+        body = {"messages": [{"role": "user", "content": PROMPT}], "stream": True}
+
+        for turn in range(2):
+            with self.post(api.CHAT_COMPLETIONS_PATH, body, {api.SESSION_HEADER: "test"}) as response:
+                events = [line[len("data: "):] for line in response.read().decode('utf-8').splitlines() if line.startswith("data: ")]
+
+            self.assertEqual(events[-1], api.SSE_DONE)
+            chunks = [json.loads(event) for event in events[:-1]]
+            self.assertEqual("".join(chunk["choices"][0]["delta"]["content"] for chunk in chunks).strip(), BASIC_RESPONSE)
+            self.assertEqual(chunks[-1]["choices"][0]["finish_reason"], api.FINISH_REASON_STOP)
+
+        # System turn and two user and assistant turns
+        self.assertEqual(len(self.server.sessions["test"]), 5)
+
+    def test_full_queue_is_rejected(self):
+        """Test requests are rejected with 429 while the queue is full"""
+        release = threading.Event()
+        running = api.Job(lambda context: str(release.wait()), "", [], False)
+        self.server.jobs.put(running)
+        self.assertEqual(running.events.get(timeout=10)[0], "start")
+
+        # Fills the queue of one request
+        self.server.jobs.put(api.Job(lambda context: "", "", [], False))
+
+        try:
+            with self.post(api.COMPLETIONS_PATH, {"prompt": PROMPT}) as response:
+                self.assertEqual(response.status, 429)
+                self.assertIn("Retry-After", response.headers)
+        finally:
+            release.set()
+
+    def test_worker_survives_errors(self):
+        """Test a job that fails only fails its request and the worker runs the next job"""
+        def error(context):
+            raise ValueError("tool failed")
+
+        failed = api.Job(error, "", [], False)
+        self.server.jobs.put(failed)
+        self.assertEqual(failed.events.get(timeout=10)[0], "start")
+        self.assertEqual(failed.events.get(timeout=10), ("error", ("tool failed", 500)))
+
+        done = api.Job(lambda context: "next", "", [], False)
+        self.server.jobs.put(done)
+        self.assertEqual(done.events.get(timeout=10)[0], "start")
+        self.assertEqual(done.events.get(timeout=10), ("done", ("next", ANY)))
+
+    def test_exit_stops_the_server(self):
+        """Test a job where core exits fails its request and stops the server"""
+        def fatal(context):
+            exit()
+
+        failed = api.Job(fatal, "", [], False)
+        self.server.jobs.put(failed)
+        self.assertEqual(failed.events.get(timeout=10)[0], "start")
+        self.assertEqual(failed.events.get(timeout=10), ("error", (api.STOPPED_ERROR, 500)))
+
+        self.server.worker.join(10)
+        self.assertFalse(self.server.worker.is_alive())
+        self.assertTrue(self.server.stopped)
+
+    def test_tool_output_is_in_the_response(self):
+        """Test the system text printed by a job is returned before its response"""
+        def tool(context):
+            core.print_system_text("Tool output")
+            return "Response"
+
+        with patch.object(api.toolchain, 'runAction', side_effect=lambda primeDirectives, action, context: tool(context)):
+            with self.post(api.CHAT_COMPLETIONS_PATH, {"messages": [{"role": "user", "content": PROMPT}]}) as response:
+                data = json.loads(response.read())
+
+        self.assertEqual(data["choices"][0]["message"]["content"], "Tool output\n\nResponse")
+
+    def test_disconnected_jobs_are_skipped_or_cancelled(self):
+        """Test queued jobs of a disconnected client are skipped and running ones are cancelled"""
+        skipped = api.Job(lambda context: self.fail("skipped job ran"), "", [], False, lambda: False)
+        self.server.jobs.put(skipped)
+        self.assertEqual(skipped.events.get(timeout=10), ("error", (api.CANCELLED_ERROR, api.CANCELLED_STATUS)))
+
+        def cancelled(context):
+            self.server.cancel(running)
+            core.check_cancelled()
+
+        running = api.Job(cancelled, "", [], False)
+        self.server.jobs.put(running)
+        self.assertEqual(running.events.get(timeout=10)[0], "start")
+        self.assertEqual(running.events.get(timeout=10), ("error", (api.CANCELLED_ERROR, api.CANCELLED_STATUS)))
+        self.assertFalse(core.cancel_event.is_set())
+
+    def test_non_streamed_client_that_leaves_cancels_its_job(self):
+        """Test the running job of a non-streamed request is cancelled when its client disconnects"""
+        started = threading.Event()
+        stopped = threading.Event()
+
+        def wait_for_cancel(primeDirectives, action, context):
+            started.set()
+
+            while not core.cancel_event.wait(0.01):
+                pass
+
+            stopped.set()
+            core.check_cancelled()
+
+        with patch.object(api.toolchain, 'runAction', side_effect=wait_for_cancel), patch.object(api, 'CONNECTION_CHECK_SECONDS', 0.05):
+            connection = http.client.HTTPConnection(api.API_HOST, self.server.server_address[1], timeout=10)
+            connection.request("POST", api.CHAT_COMPLETIONS_PATH, json.dumps({"messages": [{"role": "user", "content": PROMPT}]}), {"Content-Type": "application/json"})
+            self.assertTrue(started.wait(10))
+            connection.close()
+
+            self.assertTrue(stopped.wait(10))
+
+    def test_sessions_are_limited(self):
+        """Test the least recently used session is dropped beyond the session limit"""
+        first = self.server._get_session("first")
+        self.server._get_session("second")
+        self.assertIs(self.server._get_session("first"), first)
+        self.server._get_session("third")
+
+        self.assertEqual(list(self.server.sessions), ["first", "third"])
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.temp_dir, "magi.sock")
+        self.console = io.StringIO()
+        self.output = daemon.DaemonOutput(self.console, 16)
+        self.messages = []
+        self.received = threading.Event()
+
+        def receive_input(message):
+            self.messages.append(message)
+            self.received.set()
+
+        self.server = daemon.DaemonServer(self.socket_path, self.output, receive_input)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def connect(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(5)
+        client.connect(self.socket_path)
+
+        return client
+
+    def receive(self, client, text):
+        data = b""
+
+        while not data.decode('utf-8').endswith(text):
+            data += client.recv(1024)
+
+        return data.decode('utf-8')
+
+    def test_output_is_replayed_and_sent(self):
+        """Test attached clients receive the recent output, then the new output"""
+        self.output.write("startup output: model loaded")
+
+        with self.connect() as client:
+            self.assertEqual(self.receive(client, "loaded"), "ut: model loaded")
+
+            # Wait until the client is attached
+            while not self.output.clients:
+                threading.Event().wait(0.01)
+
+            self.output.write("response")
+            self.assertEqual(self.receive(client, "response"), "response")
+
+        self.assertEqual(self.console.getvalue(), "startup output: model loadedresponse")
+
+    def test_client_lines_are_input(self):
+        """Test the lines of a client are user input"""
+        with self.connect() as client:
+            client.sendall("hello MAGI\n\n".encode('utf-8'))
+            self.assertTrue(self.received.wait(5))
+
+        self.assertEqual(self.messages, ["hello MAGI"])
+
+    def test_slow_client_does_not_block_output(self):
+        """Test the output does not wait for a client that does not read, which is detached"""
+        with self.connect() as client, patch.object(daemon, 'CLIENT_QUEUE_SIZE', 4):
+            client.sendall("hello\n".encode('utf-8'))
+            self.assertTrue(self.received.wait(5))
+
+            for _ in range(100):
+                self.output.write("x" * 65536)
+
+            self.assertEqual(self.output.clients, {})
+
+    def test_stop_command(self):
+        """Test the stop command of a client is the exit command of MAGI"""
+        with self.connect() as client:
+            client.sendall("shutdown\n".encode('utf-8'))
+            self.assertTrue(self.received.wait(5))
+
+        self.assertEqual(self.messages, [daemon.EXIT_INPUT])
+
+    def test_running_daemon_is_not_replaced(self):
+        """Test a second daemon does not take the socket of a running one"""
+        self.assertTrue(daemon.is_running(self.socket_path))
+
+        with self.assertRaises(FileExistsError):
+            daemon.DaemonServer(self.socket_path, self.output, self.messages.append)
+
+    def test_attach(self):
+        """Test the attach client prints the daemon output, sends input lines and detaches with exit"""
+        self.output.write("ready")
+        read_fd, write_fd = os.pipe()
+        stdout = io.StringIO()
+
+        with os.fdopen(read_fd) as stdin, os.fdopen(write_fd, 'w') as pipe:
+            pipe.write("hello\n")
+            pipe.flush()
+
+            client = threading.Thread(target=daemon.attach, args=(self.socket_path, stdin, stdout))
+            client.start()
+
+            self.assertTrue(self.received.wait(5))
+            pipe.write("exit\n")
+            pipe.flush()
+            client.join(5)
+
+        self.assertEqual(self.messages, ["hello"])
+        self.assertTrue(stdout.getvalue().startswith("ready"))
+        self.assertTrue(stdout.getvalue().endswith(daemon.DETACHED_TEXT))
+
+    def test_attach_sends_every_read_line(self):
+        """Test lines that arrive together are all sent, and closing the input detaches"""
+        read_fd, write_fd = os.pipe()
+        stdout = io.StringIO()
+
+        with os.fdopen(read_fd) as stdin:
+            with os.fdopen(write_fd, 'w') as pipe:
+                pipe.write("hello\nagain\nlast")
+
+            self.assertEqual(daemon.attach(self.socket_path, stdin, stdout), 0)
+
+        for _ in range(50):
+            if len(self.messages) == 3:
+                break
+
+            time.sleep(0.1)
+
+        self.assertEqual(self.messages, ["hello", "again", "last"])
+        self.assertTrue(stdout.getvalue().endswith(daemon.DETACHED_TEXT))
+
+
+class TestConsoleInput(unittest.TestCase):
+    def test_user_input_waits_for_lines(self):
+        """Test console input returns entered lines, nothing on timeout and raises EOFError once stdin is closed"""
+        read_fd, write_fd = os.pipe()
+
+        with os.fdopen(read_fd) as stdin, os.fdopen(write_fd, 'w') as pipe, patch.object(sys, 'stdin', stdin):
+            self.assertEqual(core.user_input(0), "")
+
+            pipe.write("hello MAGI\n")
+            pipe.flush()
+            self.assertEqual(core.user_input(None), "hello MAGI")
+
+            pipe.close()
+
+            with self.assertRaises(EOFError):
+                core.user_input(None)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        # Set up model instance for testing
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.stats.clear()
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.patches = [
+            patch.object(core, 'RESPONSE_CACHE_DIR', self.cache_dir),
+            patch.object(core, 'RESPONSE_CACHE_SIZE', 1024 ** 2),
+            patch.object(core, 'RESPONSE_CACHE_CALL_TYPES', {core.CALL_TYPE_SUMMARY})
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+        shutil.rmtree(self.cache_dir)
+        core.stats.clear()
+
+    def test_cache_hit(self):
+        """Test an identical prompt reuses the cached response without running the model"""
+        first = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+        second = core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(core.model.prompts), 1)
+        self.assertEqual(core.stats["Response cache hits (summary)"], 1)
+        self.assertEqual(core.stats["Response cache misses (summary)"], 1)
+        self.assertIn("Response cache hit rate (summary): 50.0%", core.get_stats_text())
+
+    def test_other_call_types_are_not_cached(self):
+        """Test call types without cache run the model every time"""
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_TOOL)
+        core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_TOOL)
+
+        self.assertEqual(len(core.model.prompts), 2)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_expired_response(self):
+        """Test responses older than the TTL are not reused"""
+        with patch.object(core, 'RESPONSE_CACHE_TTL', 60):
+            core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+
+            with patch('time.time', return_value=core.time.time() + 120):
+                core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+
+        self.assertEqual(len(core.model.prompts), 2)
+
+    def test_used_response_expires(self):
+        """Test responses expire from their creation, even when they are used"""
+        with patch.object(core, 'RESPONSE_CACHE_TTL', 60):
+            core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+
+            with patch('time.time', return_value=core.time.time() + 30):
+                core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+
+            with patch('time.time', return_value=core.time.time() + 90):
+                core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+
+        self.assertEqual(len(core.model.prompts), 2)
+        self.assertTrue(all(name.endswith(".json") for name in os.listdir(self.cache_dir)))
+
+    def test_eviction(self):
+        """Test the oldest responses are removed when the cache is full"""
+        with patch.object(core, 'RESPONSE_CACHE_SIZE', 1):
+            core.send_prompt(PRIME_DIRECTIVES, PROMPT, [], call_type=core.CALL_TYPE_SUMMARY)
+
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_eviction_keeps_recently_used(self):
+        """Test a cache hit protects the response from eviction"""
+        start = core.time.time()
+
+        with patch('time.time', return_value=start):
+            core.write_response_cache("first", "Response")
+
+        entry_size = os.path.getsize(os.path.join(self.cache_dir, "first.json"))
+
+        with patch.object(core, 'RESPONSE_CACHE_SIZE', 2 * entry_size):
+            with patch('time.time', return_value=start + 1):
+                core.write_response_cache("second", "Response")
+
+            with patch('time.time', return_value=start + 2):
+                self.assertEqual(core.read_response_cache("first"), "Response")
+
+            with patch('time.time', return_value=start + 3):
+                core.write_response_cache("third", "Response")
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["first.json", "third.json"])
+
+
+class TestContextCompaction(unittest.TestCase):
+    def setUp(self):
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.stats.clear()
+
+    def make_context(self, turns):
+        context = [core.SYSTEM_TEXT + PRIME_DIRECTIVES + core.EOS]
+
+        for index in range(turns):
+            context.append(core.format_user_turn(f"Message {index}"))
+            context.append(f"Response {index} " + "word " * 20 + core.EOS)
+
+        return context
+
+    def test_compaction_replaces_oldest_turns(self):
+        """Test that the oldest turns are replaced by a single summary turn"""
+        context = self.make_context(4)
+        context.append(core.format_user_turn(PROMPT))
+        last_pair = context[-3:-1]
+
+        with patch.object(core, 'COMPACTION_TOKENS', 60), patch.object(core, 'summarize', return_value="Summary one") as mock_summarize:
+            core.compact_context(context)
+
+        transcript = mock_summarize.call_args[0][1]
+        self.assertIn("USER: Message 0", transcript)
+        self.assertIn("ASSISTANT: Response 0", transcript)
+        self.assertNotIn(core.EOS, transcript)
+
+        self.assertTrue(core.is_summary_turn(context))
+        self.assertEqual(context[1], core.USER_TEXT + core.COMPACTION_SUMMARY_TEXT + "Summary one" + core.EOS)
+        self.assertEqual(context[-3:-1], last_pair)
+        self.assertEqual(context[-1], core.format_user_turn(PROMPT))
+        self.assertEqual(core.stats[core.STAT_COMPACTIONS], 1)
+        self.assertGreater(core.stats[core.STAT_COMPACTED_TOKENS], 0)
+
+    def test_compaction_merges_running_summary(self):
+        """Test that a second compaction folds the previous summary into the new one"""
+        context = self.make_context(4)
+        context.insert(1, core.USER_TEXT + core.COMPACTION_SUMMARY_TEXT + "Summary one" + core.EOS)
+        context.append(core.format_user_turn(PROMPT))
+
+        with patch.object(core, 'COMPACTION_TOKENS', 60), patch.object(core, 'summarize', return_value="Summary two") as mock_summarize:
+            core.compact_context(context)
+
+        self.assertTrue(mock_summarize.call_args[0][1].startswith(core.PREVIOUS_SUMMARY + "Summary one" + core.NEW_TEXT))
+        self.assertEqual(context[1], core.USER_TEXT + core.COMPACTION_SUMMARY_TEXT + "Summary two" + core.EOS)
+        self.assertFalse(context[2].startswith(core.USER_TEXT + core.COMPACTION_SUMMARY_TEXT))
+
+    def test_short_history_is_kept(self):
+        """Test that nothing is compacted below the threshold or when compaction is disabled"""
+        for compaction_tokens in (100000, 0):
+            context = self.make_context(4)
+            context.append(core.format_user_turn(PROMPT))
+            original_context = context.copy()
+
+            with patch.object(core, 'COMPACTION_TOKENS', compaction_tokens), patch.object(core, 'summarize') as mock_summarize:
+                core.compact_context(context)
+
+            mock_summarize.assert_not_called()
+            self.assertEqual(context, original_context)
+
+    def test_only_chat_calls_compact(self):
+        """Test that chat prompts compact the conversation and other call types do not"""
+        context = self.make_context(4)
+
+        with patch.object(core, 'COMPACTION_TOKENS', 60), patch.object(core, 'summarize', return_value="Summary one"):
+            core.send_prompt(PRIME_DIRECTIVES, PROMPT, context, call_type=core.CALL_TYPE_TOOL)
+            self.assertFalse(core.is_summary_turn(context))
+
+            core.send_prompt(PRIME_DIRECTIVES, PROMPT, context)
+            self.assertTrue(core.is_summary_turn(context))
+
+
 class TestSummary(unittest.TestCase):
     def setUp(self):
         # Set up model instance for testing
@@ -322,6 +2178,95 @@ class TestSummary(unittest.TestCase):
             mock_summarize.assert_called()
             self.assertEqual(result, "Combined summary")
 
+    def test_tree_summary(self):
+        """Test blocks are summarized independently and merged by fan-in"""
+        topic = "Test topic"
+        blocks = [f"Block {i}" for i in range(5)]
+
+        with patch.object(core, 'SUMMARY_FAN_IN', 2), patch.object(core, 'summarize', side_effect=lambda topic, text: f"S({text})") as mock_summarize:
+            result = core.summarize_block_array(topic, blocks)
+
+        # 5 leaves, then 2 + 1 + 1 merges (an odd summary moves up unchanged)
+        self.assertEqual(mock_summarize.call_count, 9)
+        self.assertTrue(result.startswith("S(" + core.PARTIAL_SUMMARY))
+        self.assertIn("S(Block 4)", result)
+
+    def test_tree_summary_token_budget(self):
+        """Test the level token budget closes groups before the fan-in is reached"""
+        with patch.object(core, 'SUMMARY_FAN_IN', 4), patch.object(core, 'SUMMARY_LEVEL_TOKENS', 10):
+            groups = core.group_summaries(["a" * 6, "b" * 6, "c" * 6, "d" * 6])
+
+        self.assertEqual(groups, [["a" * 6, "b" * 6], ["c" * 6, "d" * 6]])
+
+    def test_sequential_summary_mode(self):
+        """Test the sequential mode folds blocks through update_summary"""
+        with patch.object(core, 'SUMMARY_MODE', core.SUMMARY_MODE_SEQUENTIAL), patch.object(core, 'summarize', return_value="Folded") as mock_summarize:
+            result = core.summarize_block_array("Test topic", ["Block 1", "Block 2", "Block 3"])
+
+        self.assertEqual(mock_summarize.call_count, 2)
+        self.assertEqual(result, "Folded")
+
+    def test_chunk_text(self):
+        """Test text is split at paragraph boundaries into blocks within the token size"""
+        paragraphs = ["a" * 40, "b" * 40, "c" * 40]
+        text = "\n\n".join(paragraphs)
+
+        with patch.object(core, 'TEXT_BLOCK_TOKENS', 90), patch.object(core, 'TEXT_BLOCK_OVERLAP_TOKENS', 0):
+            blocks = list(core.chunk_text(text))
+
+        # Paragraph layout is kept inside a block
+        self.assertEqual(blocks, [paragraphs[0] + "\n\n" + paragraphs[1], paragraphs[2]])
+
+    def test_chunk_text_overlap(self):
+        """Test each block starts with the end of the previous one"""
+        text = "\n".join(["line" + str(i) for i in range(10)])
+
+        with patch.object(core, 'TEXT_BLOCK_TOKENS', 20), patch.object(core, 'TEXT_BLOCK_OVERLAP_TOKENS', 6):
+            blocks = list(core.chunk_text(text))
+
+        for previous, block in zip(blocks, blocks[1:]):
+            self.assertTrue(block.startswith(previous.split("\n")[-1]))
+
+        for block in blocks:
+            self.assertLessEqual(core.count_text_tokens(block), 20)
+
+    def test_chunk_text_heading(self):
+        """Test a heading starts a new block once the current one is half full"""
+        text = "a" * 30 + "\n\n# Heading\n\n" + "b" * 10
+
+        with patch.object(core, 'TEXT_BLOCK_TOKENS', 50), patch.object(core, 'TEXT_BLOCK_OVERLAP_TOKENS', 0):
+            blocks = list(core.chunk_text(text))
+
+        self.assertEqual(blocks, ["a" * 30, "# Heading\n\n" + "b" * 10])
+
+    def test_chunk_text_long_word(self):
+        """Test a word bigger than a block is cut into blocks"""
+        with patch.object(core, 'TEXT_BLOCK_TOKENS', 10), patch.object(core, 'TEXT_BLOCK_OVERLAP_TOKENS', 0):
+            blocks = list(core.chunk_text("x" * 25))
+
+        self.assertEqual("".join(blocks), "x" * 25)
+        self.assertTrue(all(len(block) <= 10 for block in blocks))
+
+    def test_chunk_text_tokenizes_once(self):
+        """Test the text is tokenized once and split on character offsets"""
+        paragraphs = ["é" * 40, "ü" * 40, "c" * 40]
+        text = "\n\n".join(paragraphs)
+
+        with patch.object(core, 'TEXT_BLOCK_TOKENS', 90), patch.object(core, 'TEXT_BLOCK_OVERLAP_TOKENS', 0), \
+                patch.object(core.model, 'tokenize', wraps=core.model.tokenize) as mock_tokenize:
+            blocks = list(core.chunk_text(text))
+
+        self.assertEqual(mock_tokenize.call_count, 1)
+        self.assertEqual(blocks, [paragraphs[0] + "\n\n" + paragraphs[1], paragraphs[2]])
+
+    def test_token_lengths_are_cached(self):
+        """Test each token id is detokenized once to get its length"""
+        with patch.dict(core.token_byte_lengths, clear=True), patch.object(core.model, 'detokenize', wraps=core.model.detokenize) as mock_detokenize:
+            self.assertEqual(core.get_token_lengths("abab é".encode('utf-8')), [1, 1, 1, 1, 1, 2])
+            core.get_token_lengths("ba".encode('utf-8'))
+
+        self.assertEqual(mock_detokenize.call_count, 4)
+
     def test_load_mission_data(self):
         """Test load_mission_data with various mission data scenarios"""
         prompt = "Test topic"
@@ -399,5 +2344,80 @@ class TestBinaryQuestion(unittest.TestCase):
             self.assertFalse(result)
 
 
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        core.model = MockLlama(model_path="model.gguf", n_ctx=core.CONTEXT_SIZE)
+        core.clear_prompt_cache()
+        self.system_texts = []
+        self.decisions = []
+
+        # NERV runs on mocked comms and toolchain, the captain and soldiers are prompted through core
+        mock_comms = types.ModuleType('comms')
+        setattr(mock_comms, 'printSystemText', self.system_texts.append)
+        setattr(mock_comms, 'printMagiText', lambda text, streamed=False: None)
+        mock_toolchain = types.ModuleType('toolchain')
+        setattr(mock_toolchain, 'print_tools', lambda: "")
+        setattr(mock_toolchain, 'runAction', lambda primeDirectives, action, context, is_agent=False: core.send_prompt(primeDirectives, action, context, stream=True))
+
+        config = {"CAPTAIN_NAME": "Captain", "CAPTAIN_PRIME_DIRECTIVES": "You lead the team."}
+
+        with patch.dict(sys.modules, {'comms': mock_comms, 'toolchain': mock_toolchain}), patch.dict(core.config, config):
+            sys.modules.pop('agent', None)
+            import agent
+
+        self.agent = agent
+
+    def run_mission(self, decisions):
+        self.decisions = decisions
+        send_prompt = core.send_prompt
+
+        # Decisions come from the list, every other prompt from the mock model
+        def decide(primeDirectives, prompt, context, **kwargs):
+            if kwargs.get("choices"):
+                return self.decisions.pop(0)
+
+            return send_prompt(primeDirectives, prompt, context, **kwargs)
+
+        with patch.object(core, 'send_prompt', side_effect=decide):
+            return self.agent.runMission("Find the answer", "")
+
+    def test_failed_decision_is_retried(self):
+        """Test an error text of a decision is retried instead of completing the mission"""
+        self.run_mission([core.OVERSIZED_PROMPT_ERROR, self.agent.MOVE_COMPLETE])
+
+        self.assertEqual(self.decisions, [])
+        self.assertNotIn(self.agent.FORCE_COMPLETE_TEXT, self.system_texts)
+
+    def test_failed_decisions_complete_the_mission(self):
+        """Test the mission is force-completed after the retries of unusable decisions"""
+        self.run_mission([core.OVERSIZED_PROMPT_ERROR] * self.agent.MAX_DECISION_RETRIES)
+
+        self.assertIn(self.agent.FORCE_COMPLETE_TEXT, self.system_texts)
+
+    def test_mission_with_compaction(self):
+        """Test a mission runs on compacted captain and soldier contexts without keeping the instructions"""
+        core.stats.clear()
+        moves = [self.agent.MOVE_SPAWN, f"{self.agent.MOVE_TALK} 1", f"{self.agent.MOVE_TALK} 1", self.agent.MOVE_COMPLETE]
+
+        with patch.object(core, 'COMPACTION_TOKENS', 200):
+            response = self.run_mission(moves)
+
+        captain = self.agent.captain
+        soldier = self.agent.agent_pool[1]
+        instruction = self.agent.COMPLETE_INSTRUCTION.format(mission="Find the answer", data="").rstrip()
+
+        self.assertEqual(self.decisions, [])
+        self.assertEqual(response, BASIC_RESPONSE)
+        self.assertGreaterEqual(core.stats[core.STAT_COMPACTIONS], 2)
+        self.assertTrue(core.is_summary_turn(captain.context))
+        self.assertTrue(core.is_summary_turn(soldier.context))
+
+        # The last exchange is kept whole, only its transient instruction is removed
+        self.assertTrue(captain.context[-2].startswith(core.USER_TEXT))
+        self.assertNotIn(instruction, "".join(captain.context))
+
+
+
 if __name__ == '__main__':
     unittest.main()
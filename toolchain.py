@@ -149,8 +149,8 @@ def _sanitize_tool_name(response: str) -> str:
     return tool
 
 
-def run_core_protocol(primeDirectives: str, action: str, context: list[str], hide_reasoning: bool = False) -> str:
-    response = core.send_prompt(primeDirectives, action + CORE_PROTOCOL, context, hide_reasoning)
+def run_core_protocol(primeDirectives: str, action: str, context: list[str], hide_reasoning: bool = False, stream: bool = False) -> str:
+    response = core.send_prompt(primeDirectives, action + CORE_PROTOCOL, context, hide_reasoning, stream)
 
     # Remove Core Protocol from context (len(context) is always >= 3 after sending a prompt)
     context[-2] = context[-2].replace(CORE_PROTOCOL, '').strip()
@@ -286,8 +286,9 @@ def runAction(primeDirectives: str, action: str, context: list[str], is_agent: b
         if available_tools == EMPTY_JSON_TEXT:
             break
 
-        # Select tool
-        allowed_options = "\n".join(list(TOOLS.keys()) + [CONTINUE_TEXT])
+        # Select tool (the answer is restricted to the allowed options)
+        option_list = list(TOOLS.keys()) + [CONTINUE_TEXT]
+        allowed_options = "\n".join(option_list)
 
         prompt = (
             TOOL_SELECTION_TEXT + allowed_options +
@@ -295,7 +296,7 @@ def runAction(primeDirectives: str, action: str, context: list[str], is_agent: b
             TASK_SECTION_TEXT + extended_action
         )
 
-        tool = core.send_prompt(TOOL_SELECTION_SYSTEM_PROMPT, prompt, context[:], hide_reasoning = True)
+        tool = core.send_prompt(TOOL_SELECTION_SYSTEM_PROMPT, prompt, context[:], hide_reasoning = True, call_type = core.CALL_TYPE_TOOL, choices = option_list)
         tool = _sanitize_tool_name(tool)
 
         if tool == CONTINUE_TEXT:
@@ -315,11 +316,11 @@ def runAction(primeDirectives: str, action: str, context: list[str], is_agent: b
             extended_action += error
             comms.printSystemText(error)
 
-    # Run action
-    response = run_core_protocol(primeDirectives, extended_action, context)
+    # Run action (the response is printed while it is generated)
+    response = run_core_protocol(primeDirectives, extended_action, context, stream = True)
 
-    # Print the response
-    comms.printMagiText("\n" + response)
+    # Send the response to the remote comms
+    comms.printMagiText("\n" + response, streamed = True)
 
     # Remove extended reasoning
     response = core.remove_reasoning(response)